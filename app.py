@@ -1,28 +1,447 @@
-from flask import Flask, render_template, request, redirect, session, url_for, flash
+from flask import Flask, render_template, request, redirect, session, url_for, flash, g, jsonify, send_file
+import click
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import os
+import queue
+import re
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FuturoTimeout
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 
 app = Flask(__name__)
 app.secret_key = "chave_secreta_almoxarifado"
-DATABASE = "banco.db"
+DATABASE = os.environ.get("ALMOXARIFADO_DB", "banco.db")
+
+# Arquivos mensais de movimentos antigos (AAAA-MM.db), ao lado do banco por padrão
+ARQUIVO_DIR = os.environ.get("ALMOXARIFADO_ARQUIVO_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(DATABASE)), "arquivo"
+)
+
+# Quantidade máxima de conexões ociosas mantidas por processo (gunicorn worker)
+DB_POOL_SIZE = int(os.environ.get("ALMOXARIFADO_DB_POOL_SIZE", 8))
 
 # ================= CONTEXTO GLOBAL (JINJA) =================
 @app.context_processor
 def inject_datetime():
     return dict(datetime=datetime)
 
+# ================= PERFIL DE ARMAZENAMENTO (SQLite) =================
+# Aplicado uma vez por conexão em conectar(). Cada PRAGMA pode ser sobrescrito
+# na inicialização com ALMOXARIFADO_SQLITE_<NOME>, ex.: ALMOXARIFADO_SQLITE_CACHE_SIZE=-64000
+PERFIL_SQLITE = {
+    "journal_mode": "WAL",            # leitores não bloqueiam o escritor (e vice-versa)
+    "synchronous": "NORMAL",          # seguro em WAL; fsync só no checkpoint
+    "busy_timeout": 10000,            # ms aguardando o lock de escrita
+    "cache_size": -20000,             # negativo = KiB (~20 MB por conexão)
+    "mmap_size": 268435456,           # 256 MB
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+    "wal_autocheckpoint": 1000,       # checkpoint PASSIVE a cada ~1000 páginas
+    "journal_size_limit": 67108864,   # trunca o -wal para 64 MB após checkpoint
+}
+
+for _pragma in PERFIL_SQLITE:
+    _valor = os.environ.get(f"ALMOXARIFADO_SQLITE_{_pragma.upper()}")
+    if _valor is not None:
+        PERFIL_SQLITE[_pragma] = _valor
+
+
+# ================= MÉTRICAS (Prometheus) =================
+# Contadores por processo (cada worker do gunicorn expõe os seus em /metrics).
+# As conexões de conectar() usam ConexaoInstrumentada, que mede cada comando SQL
+# e atribui o custo ao endpoint da requisição em andamento na thread.
+METRICAS_ATIVAS = os.environ.get("ALMOXARIFADO_METRICAS", "1") != "0"
+METRICAS_TOKEN = os.environ.get("ALMOXARIFADO_METRICS_TOKEN")  # Bearer opcional p/ o scraper
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Novas tentativas de BEGIN IMMEDIATE quando o busy_timeout estoura. O busy_timeout
+# é dividido entre as tentativas: a espera total de um BEGIN continua ~busy_timeout
+BUSY_TENTATIVAS = int(os.environ.get("ALMOXARIFADO_BUSY_TENTATIVAS", 3))
+
+_metricas_lock = threading.Lock()
+_metricas = {
+    "requisicoes": {},  # (endpoint, método, status) -> total
+    "latencia": {},     # endpoint -> [contagem por bucket..., soma, total]
+    "sql": {},          # endpoint -> [comandos, segundos, linhas lidas]
+    "busy": {},         # (endpoint, desfecho) -> total
+}
+_contexto_metricas = threading.local()
+
+
+def endpoint_atual():
+    return getattr(_contexto_metricas, "endpoint", None) or "fora_de_requisicao"
+
+
+def registrar_sql(comandos, segundos, linhas):
+    chave = endpoint_atual()
+    with _metricas_lock:
+        valores = _metricas["sql"].setdefault(chave, [0, 0.0, 0])
+        valores[0] += comandos
+        valores[1] += segundos
+        valores[2] += linhas
+
+
+def registrar_busy(desfecho):
+    chave = (endpoint_atual(), desfecho)
+    with _metricas_lock:
+        _metricas["busy"][chave] = _metricas["busy"].get(chave, 0) + 1
+
+
+def observar_requisicao(endpoint, metodo, status, segundos):
+    with _metricas_lock:
+        chave = (endpoint, metodo, status)
+        _metricas["requisicoes"][chave] = _metricas["requisicoes"].get(chave, 0) + 1
+
+        histograma = _metricas["latencia"].setdefault(endpoint, [0] * len(METRICAS_BUCKETS) + [0.0, 0])
+        for i, limite in enumerate(METRICAS_BUCKETS):
+            if segundos <= limite:
+                histograma[i] += 1
+        histograma[-2] += segundos
+        histograma[-1] += 1
+
+
+# ================= CONSULTAS LENTAS =================
+# Comandos acima do limite (execução + leitura das linhas) entram num top-N
+# por (SQL normalizado, endpoint), com o EXPLAIN QUERY PLAN da primeira ocorrência.
+CONSULTA_LENTA_MS = float(os.environ.get("ALMOXARIFADO_CONSULTA_LENTA_MS", 100))
+CONSULTAS_LENTAS_TOP = int(os.environ.get("ALMOXARIFADO_CONSULTAS_LENTAS_TOP", 50))
+
+_consultas_lentas = {}
+_consultas_lentas_lock = threading.Lock()
+
+
+def normalizar_sql(sql):
+    """Tira literais e espaços do SQL para agrupar comandos equivalentes."""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip()
+    sql = re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", sql)
+    sql = re.sub(r"(\([^()]*\))(?:\s*,\s*\1)+", r"\1, ...", sql)
+    return sql
+
+
+def formato_parametros(parametros, lote=None):
+    """Descreve os tipos dos parâmetros, sem os valores (ex.: "(int, str) x 500")."""
+    if isinstance(parametros, dict):
+        formato = "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parametros.items()) + "}"
+    else:
+        tipos = [type(v).__name__ for v in parametros]
+        if len(tipos) > 8:
+            contagem = OrderedDict()
+            for tipo in tipos:
+                contagem[tipo] = contagem.get(tipo, 0) + 1
+            formato = "(" + ", ".join(f"{tipo}×{n}" for tipo, n in contagem.items()) + ")"
+        else:
+            formato = "(" + ", ".join(tipos) + ")"
+    return f"{formato} x {lote}" if lote is not None else formato
+
+
+def plano_consulta(conexao, sql, parametros):
+    """EXPLAIN QUERY PLAN como texto indentado; vazio para comandos sem plano."""
+    if not re.match(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", sql, re.IGNORECASE):
+        return ""
+    try:
+        # Cursor comum: o EXPLAIN não entra nas métricas nem no log
+        linhas = sqlite3.Connection.execute(conexao, "EXPLAIN QUERY PLAN " + sql, parametros).fetchall()
+    except sqlite3.Error as e:
+        return f"(sem plano: {e})"
+
+    profundidade = {0: 0}
+    saida = []
+    for linha in linhas:
+        id_no, pai, detalhe = linha[0], linha[1], linha[3]
+        profundidade[id_no] = profundidade.get(pai, 0) + 1
+        saida.append("  " * (profundidade[id_no] - 1) + detalhe)
+    return "\n".join(saida)
+
+
+def registrar_consulta_lenta(conexao, sql, parametros, segundos, lote=None):
+    chave = (normalizar_sql(sql), endpoint_atual())
+    agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    with _consultas_lentas_lock:
+        item = _consultas_lentas.get(chave)
+        if item is None:
+            item = {
+                "sql": chave[0],
+                "endpoint": chave[1],
+                "parametros": formato_parametros(parametros, lote),
+                "plano": None,
+                "ocorrencias": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+            }
+            _consultas_lentas[chave] = item
+        item["ocorrencias"] += 1
+        item["total_ms"] += segundos * 1000
+        item["max_ms"] = max(item["max_ms"], segundos * 1000)
+        item["ultima_vez"] = agora
+        capturar_plano = item["plano"] is None
+        if capturar_plano:
+            item["plano"] = ""
+
+        # Mantém só os N piores pelo tempo máximo
+        if len(_consultas_lentas) > CONSULTAS_LENTAS_TOP:
+            menor = min(_consultas_lentas, key=lambda k: _consultas_lentas[k]["max_ms"])
+            del _consultas_lentas[menor]
+
+    if capturar_plano:
+        item["plano"] = plano_consulta(conexao, sql, parametros)
+
+    app.logger.warning(
+        "Consulta lenta (%.1f ms) em %s: %s %s",
+        segundos * 1000, chave[1], chave[0], item["parametros"]
+    )
+
+
+def erro_de_lock(erro):
+    mensagem = str(erro).lower()
+    return "locked" in mensagem or "busy" in mensagem
+
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """Cursor que mede tempo, comandos e linhas lidas (ver registrar_sql)."""
+
+    _linhas_iteradas = 0
+    _tempo_iteracao = 0.0
+
+    # Comando em andamento, para o log de consultas lentas
+    _comando = None
+    _tempo_comando = 0.0
+
+    def _descarregar_iteracao(self):
+        if self._linhas_iteradas or self._tempo_iteracao:
+            registrar_sql(0, self._tempo_iteracao, self._linhas_iteradas)
+            self._linhas_iteradas = 0
+            self._tempo_iteracao = 0.0
+
+    def _somar_tempo(self, segundos):
+        # Registra a consulta uma vez, quando execução + leitura passam do limite
+        self._tempo_comando += segundos
+        if self._comando is not None and self._tempo_comando * 1000 >= CONSULTA_LENTA_MS:
+            sql, parametros, lote = self._comando
+            self._comando = None
+            registrar_consulta_lenta(self.connection, sql, parametros, self._tempo_comando, lote)
+
+    def execute(self, sql, parametros=(), /):
+        self._descarregar_iteracao()
+        self._comando = (sql, parametros, None)
+        self._tempo_comando = 0.0
+
+        # Só o BEGIN é seguro repetir: nada da transação foi feito ainda
+        if BUSY_TENTATIVAS and sql.lstrip().upper().startswith("BEGIN"):
+            total = int(PERFIL_SQLITE["busy_timeout"])
+            sqlite3.Connection.execute(
+                self.connection, f"PRAGMA busy_timeout = {total // (BUSY_TENTATIVAS + 1)}"
+            )
+            try:
+                return self._executar(sql, parametros, BUSY_TENTATIVAS)
+            finally:
+                sqlite3.Connection.execute(self.connection, f"PRAGMA busy_timeout = {total}")
+        return self._executar(sql, parametros, 0)
+
+    def _executar(self, sql, parametros, tentativas):
+        tentativa = 0
+        while True:
+            inicio = time.perf_counter()
+            try:
+                super().execute(sql, parametros)
+                self._somar_tempo(time.perf_counter() - inicio)
+                return self
+            except sqlite3.OperationalError as e:
+                if not erro_de_lock(e):
+                    raise
+                if tentativa >= tentativas:
+                    registrar_busy("erro")
+                    raise
+                registrar_busy("retentativa")
+                tentativa += 1
+                time.sleep(0.05 * 2 ** tentativa)
+            finally:
+                registrar_sql(1, time.perf_counter() - inicio, 0)
+
+    def executemany(self, sql, parametros, /):
+        self._descarregar_iteracao()
+        parametros = parametros if isinstance(parametros, (list, tuple)) else list(parametros)
+        self._comando = (sql, parametros[0] if parametros else (), len(parametros))
+        self._tempo_comando = 0.0
+        inicio = time.perf_counter()
+        try:
+            super().executemany(sql, parametros)
+            self._somar_tempo(time.perf_counter() - inicio)
+            return self
+        except sqlite3.OperationalError as e:
+            if erro_de_lock(e):
+                registrar_busy("erro")
+            raise
+        finally:
+            registrar_sql(1, time.perf_counter() - inicio, 0)
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        linha = super().fetchone()
+        decorrido = time.perf_counter() - inicio
+        registrar_sql(0, decorrido, 0 if linha is None else 1)
+        self._somar_tempo(decorrido)
+        return linha
+
+    def fetchmany(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        linhas = super().fetchmany(*args, **kwargs)
+        decorrido = time.perf_counter() - inicio
+        registrar_sql(0, decorrido, len(linhas))
+        self._somar_tempo(decorrido)
+        return linhas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        linhas = super().fetchall()
+        decorrido = time.perf_counter() - inicio
+        registrar_sql(0, decorrido, len(linhas))
+        self._somar_tempo(decorrido)
+        return linhas
+
+    def __next__(self):
+        # Acumula no cursor e registra só ao fim da iteração (evita o lock por linha)
+        inicio = time.perf_counter()
+        try:
+            linha = super().__next__()
+        except StopIteration:
+            decorrido = time.perf_counter() - inicio
+            self._tempo_iteracao += decorrido
+            self._descarregar_iteracao()
+            self._somar_tempo(decorrido)
+            raise
+        decorrido = time.perf_counter() - inicio
+        self._tempo_iteracao += decorrido
+        self._linhas_iteradas += 1
+        self._somar_tempo(decorrido)
+        return linha
+
+    def close(self):
+        self._descarregar_iteracao()
+        super().close()
+
+
+class ConexaoInstrumentada(sqlite3.Connection):
+    """Conexão cujos cursores (inclusive os de execute()) são CursorInstrumentado."""
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=(), /):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros, /):
+        return self.cursor().executemany(sql, parametros)
+
+
+@app.before_request
+def iniciar_metricas_requisicao():
+    _contexto_metricas.endpoint = request.endpoint or "desconhecido"
+    g.inicio_requisicao = time.perf_counter()
+
+
+@app.after_request
+def registrar_metricas_requisicao(resposta):
+    inicio = g.pop('inicio_requisicao', None)
+    if inicio is not None:
+        observar_requisicao(
+            request.endpoint or "desconhecido",
+            request.method,
+            resposta.status_code,
+            time.perf_counter() - inicio
+        )
+    return resposta
+
+
+@app.teardown_request
+def limpar_metricas_requisicao(exc):
+    _contexto_metricas.endpoint = None
+
+
 # ================= FUNÇÕES DE BANCO =================
 def conectar():
-    conn = sqlite3.connect(DATABASE)
+    """
+    Abre uma nova conexão já configurada (row_factory e PERFIL_SQLITE).
+    As rotas devem usar obter_db(); conectar() fica para scripts e para o pool.
+    """
+    # Permite que a conexão seja usada por outra thread do pool
+    conn = sqlite3.connect(
+        DATABASE,
+        timeout=int(PERFIL_SQLITE["busy_timeout"]) / 1000,
+        check_same_thread=False,
+        factory=ConexaoInstrumentada if METRICAS_ATIVAS else sqlite3.Connection
+    )
     conn.row_factory = sqlite3.Row
+    for pragma, valor in PERFIL_SQLITE.items():
+        conn.execute(f"PRAGMA {pragma} = {valor}")
     return conn
 
+
+def checkpoint_wal(modo="PASSIVE"):
+    """
+    Executa um checkpoint do WAL. PASSIVE não bloqueia ninguém;
+    TRUNCATE espera os leitores e zera o arquivo -wal.
+    Retorna (ocupado, páginas no wal, páginas copiadas).
+    """
+    conn = conectar()
+    try:
+        return tuple(conn.execute(f"PRAGMA wal_checkpoint({modo})").fetchone())
+    finally:
+        conn.close()
+
+
+# Conexões ociosas, reaproveitadas entre requisições do mesmo processo
+_pool_conexoes = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+def obter_db():
+    """
+    Retorna a conexão da requisição atual, guardada em `g`.
+    A conexão vem do pool (ou é criada) na primeira chamada e devolvida no teardown.
+    """
+    if 'db' not in g:
+        try:
+            g.db = _pool_conexoes.get_nowait()
+        except queue.Empty:
+            g.db = conectar()
+    return g.db
+
+
+@app.teardown_appcontext
+def devolver_db(exc):
+    db = g.pop('db', None)
+    if db is None:
+        return
+
+    # Nunca devolve ao pool uma transação pela metade
+    if db.in_transaction:
+        db.rollback()
+
+    try:
+        _pool_conexoes.put_nowait(db)
+    except queue.Full:
+        db.close()
+
 # ================= CRIAÇÃO DO BANCO =================
 def criar_banco():
     conn = conectar()
-    conn.execute("PRAGMA foreign_keys = ON")
     cursor = conn.cursor()
 
     # ================= USUÁRIOS =================
@@ -85,6 +504,11 @@ def criar_banco():
     )
     """)
 
+    # ================= TABELAS POR TIPO (LEGADO) =================
+    # Entradas, saídas, transferências, ajustes e novos produtos passam a ser
+    # views sobre movimentos na migração 5; com a view criada, os CREATE TABLE
+    # IF NOT EXISTS abaixo não fazem nada.
+
     # ================= ENTRADAS =================
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS entradas (
@@ -165,8 +589,9 @@ def criar_banco():
     ).fetchone()[0]
 
     if total == 0:
+        # OR IGNORE: vários workers podem inicializar o banco ao mesmo tempo
         cursor.execute("""
-        INSERT INTO usuarios (nome, email, cpf, senha, perfil)
+        INSERT OR IGNORE INTO usuarios (nome, email, cpf, senha, perfil)
         VALUES (?, ?, ?, ?, ?)
         """, (
             "Administrador",
@@ -177,17 +602,716 @@ def criar_banco():
         ))
 
     conn.commit()
+
+    versao = migrar_banco(conn)
     conn.close()
 
-    print("✅ Banco criado com sucesso")
+    print(f"✅ Banco criado com sucesso (schema v{versao})")
+
+# ================= AGREGADOS DE ESTOQUE =================
+# estoque_total, estoque_por_produto e estoque_por_setor são mantidos por triggers
+# sobre estoque; contagem_movimentos por trigger sobre movimentos (migração 2).
+def calcular_agregados(cursor):
+    """Recalcula do zero, a partir de estoque e movimentos, o conteúdo esperado das tabelas de agregados."""
+    total = cursor.execute("""
+        SELECT COALESCE(SUM(quantidade), 0) AS quantidade, COALESCE(SUM(peso), 0) AS peso
+        FROM estoque
+    """).fetchone()
+
+    return {
+        "estoque_total": {1: (total[0], total[1])},
+        "estoque_por_produto": {
+            row[0]: (row[1], row[2]) for row in cursor.execute("""
+                SELECT produto_id, SUM(quantidade), SUM(peso) FROM estoque GROUP BY produto_id
+            """)
+        },
+        "estoque_por_setor": {
+            row[0]: (row[1], row[2]) for row in cursor.execute("""
+                SELECT setor, SUM(quantidade), SUM(peso) FROM estoque GROUP BY setor
+            """)
+        },
+        "contagem_movimentos": contagem_movimentos_total(cursor),
+    }
+
+
+def contagem_movimentos_total(cursor):
+    """Movimentos por tipo no banco principal + os já levados para o arquivo mensal."""
+    contagem = {
+        row[0]: row[1] for row in cursor.execute("SELECT tipo, COUNT(*) FROM movimentos GROUP BY tipo")
+    }
+    # arquivo_periodos só existe a partir da migração 7
+    if cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'arquivo_periodos'"
+    ).fetchone():
+        for tipo, total in cursor.execute("""
+            SELECT j.key, SUM(j.value)
+            FROM arquivo_periodos, json_each(arquivo_periodos.contagem) AS j
+            GROUP BY j.key
+        """):
+            contagem[tipo] = contagem.get(tipo, 0) + total
+    return {tipo: (total,) for tipo, total in contagem.items()}
+
+
+def recalcular_agregados(cursor):
+    """Reescreve as tabelas de agregados (usar dentro de uma transação)."""
+    esperado = calcular_agregados(cursor)
+
+    cursor.execute("DELETE FROM estoque_total")
+    cursor.execute("DELETE FROM estoque_por_produto")
+    cursor.execute("DELETE FROM estoque_por_setor")
+    cursor.execute("DELETE FROM contagem_movimentos")
+
+    cursor.execute(
+        "INSERT INTO estoque_total (id, quantidade, peso) VALUES (1, ?, ?)",
+        esperado["estoque_total"][1]
+    )
+    cursor.executemany(
+        "INSERT INTO estoque_por_produto (produto_id, quantidade, peso) VALUES (?, ?, ?)",
+        [(chave, *valores) for chave, valores in esperado["estoque_por_produto"].items()]
+    )
+    cursor.executemany(
+        "INSERT INTO estoque_por_setor (setor, quantidade, peso) VALUES (?, ?, ?)",
+        [(chave, *valores) for chave, valores in esperado["estoque_por_setor"].items()]
+    )
+    cursor.executemany(
+        "INSERT INTO contagem_movimentos (tipo, total) VALUES (?, ?)",
+        [(chave, *valores) for chave, valores in esperado["contagem_movimentos"].items()]
+    )
+
+
+def verificar_agregados(cursor, tolerancia=1e-6):
+    """
+    Compara as tabelas de agregados com o recálculo do zero.
+    Retorna uma lista de divergências (tabela, chave, gravado, esperado).
+    """
+    esperado = calcular_agregados(cursor)
+    gravado = {
+        "estoque_total": {
+            row[0]: (row[1], row[2])
+            for row in cursor.execute("SELECT id, quantidade, peso FROM estoque_total")
+        },
+        "estoque_por_produto": {
+            row[0]: (row[1], row[2])
+            for row in cursor.execute("SELECT produto_id, quantidade, peso FROM estoque_por_produto")
+        },
+        "estoque_por_setor": {
+            row[0]: (row[1], row[2])
+            for row in cursor.execute("SELECT setor, quantidade, peso FROM estoque_por_setor")
+        },
+        "contagem_movimentos": {
+            row[0]: (row[1],)
+            for row in cursor.execute("SELECT tipo, total FROM contagem_movimentos")
+        },
+    }
+
+    divergencias = []
+    for tabela, valores_esperados in esperado.items():
+        for chave in set(valores_esperados) | set(gravado[tabela]):
+            atual = gravado[tabela].get(chave)
+            correto = valores_esperados.get(chave)
+            zeros = (0,) * len(atual or correto)
+            if any(abs(a - b) > tolerancia for a, b in zip(atual or zeros, correto or zeros)):
+                divergencias.append((tabela, chave, atual, correto))
+
+    return divergencias
+
+
+# ================= LIVRO ÚNICO DE MOVIMENTOS =================
+# movimentos é o único registro gravado. As antigas tabelas por tipo viram
+# views sobre ele (migração 5), com os mesmos nomes e colunas de antes.
+# tabela -> (tipo, SELECT das colunas de movimentos, view equivalente)
+TABELAS_POR_TIPO = {
+    "relatorio_novos_produtos": (
+        "novo",
+        "SELECT produto_id, NULL, setor, NULL, NULL, usuario_id, data FROM relatorio_novos_produtos ORDER BY id",
+        "SELECT id, produto_id, para_setor AS setor, usuario_id, data FROM movimentos WHERE tipo = 'novo'",
+    ),
+    "entradas": (
+        "entrada",
+        "SELECT produto_id, NULL, setor, quantidade, peso, usuario_id, data FROM entradas ORDER BY id",
+        "SELECT id, produto_id, para_setor AS setor, quantidade, peso, data, usuario_id "
+        "FROM movimentos WHERE tipo = 'entrada'",
+    ),
+    "saidas": (
+        "saida",
+        "SELECT produto_id, setor, NULL, quantidade, peso, usuario_id, data FROM saidas ORDER BY id",
+        "SELECT id, produto_id, de_setor AS setor, quantidade, peso, data, usuario_id "
+        "FROM movimentos WHERE tipo = 'saida'",
+    ),
+    "transferencias": (
+        "transferencia",
+        "SELECT produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data FROM transferencias ORDER BY id",
+        "SELECT id, produto_id, de_setor, para_setor, quantidade, peso, data, usuario_id "
+        "FROM movimentos WHERE tipo = 'transferencia'",
+    ),
+    "ajustes_saldo": (
+        "ajuste",
+        "SELECT produto_id, NULL, setor, quantidade, peso, usuario_id, data FROM ajustes_saldo ORDER BY id",
+        "SELECT id, produto_id, para_setor AS setor, quantidade, peso, usuario_id, data "
+        "FROM movimentos WHERE tipo = 'ajuste'",
+    ),
+}
+
+
+def unificar_livro_movimentos(cursor):
+    """
+    Copia para movimentos as linhas das tabelas por tipo que ainda não têm par lá.
+    registrar_movimento gravava as duas com os mesmos valores, então o par é
+    casado por (produto, setores, quantidade, peso, usuário, data), contando
+    repetições: duas entradas idênticas só casam com duas linhas em movimentos.
+    Em 'novo' a tabela antiga não tinha quantidade/peso; a cópia entra com 0.
+    """
+    copiadas = 0
+    for tabela, (tipo, consulta, _) in TABELAS_POR_TIPO.items():
+        sem_quantidade = tipo == "novo"
+
+        def chave(linha):
+            produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data = linha
+            if sem_quantidade:
+                return (produto_id, de_setor, para_setor, usuario_id, data)
+            return (produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data)
+
+        existentes = {}
+        for linha in cursor.execute("""
+            SELECT produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data
+            FROM movimentos WHERE tipo = ?
+        """, (tipo,)):
+            k = chave(tuple(linha))
+            existentes[k] = existentes.get(k, 0) + 1
+
+        faltantes = []
+        for linha in cursor.execute(consulta).fetchall():
+            linha = tuple(linha)
+            k = chave(linha)
+            if existentes.get(k):
+                existentes[k] -= 1
+                continue
+            produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data = linha
+            faltantes.append((tipo, produto_id, de_setor, para_setor,
+                              quantidade or 0, peso or 0, usuario_id, data))
+
+        cursor.executemany("""
+            INSERT INTO movimentos (tipo, produto_id, de_setor, para_setor,
+                                    quantidade, peso, usuario_id, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, faltantes)
+        copiadas += len(faltantes)
+
+    if copiadas:
+        print(f"   {copiadas} movimento(s) só existiam nas tabelas por tipo e foram copiados")
+
+
+# ================= RESUMO DIÁRIO DE MOVIMENTOS =================
+# movimentos_diarios soma os movimentos por (dia, tipo, produto, setor) e é
+# mantido por trigger a cada INSERT em movimentos (migração 8). O setor é o de
+# origem quando existe (saída, transferência) e o de destino nos demais tipos.
+# Não há trigger de DELETE: o arquivamento mensal tira linhas de movimentos,
+# mas o resumo continua cobrindo o histórico inteiro.
+SELECT_RESUMO_DIARIO = """
+    SELECT substr(data, 1, 10), tipo, produto_id, COALESCE(de_setor, para_setor, ''),
+           COUNT(*), COALESCE(SUM(quantidade), 0), COALESCE(SUM(peso), 0)
+    FROM movimentos
+    WHERE data IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+"""
+
+UPSERT_RESUMO_DIARIO = """
+    INSERT INTO movimentos_diarios (dia, tipo, produto_id, setor, movimentos, quantidade, peso)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (dia, tipo, produto_id, setor) DO UPDATE SET
+        movimentos = movimentos + excluded.movimentos,
+        quantidade = quantidade + excluded.quantidade,
+        peso = peso + excluded.peso
+"""
+
+
+def preencher_movimentos_diarios(cursor):
+    """Reconstrói o resumo a partir de movimentos e dos meses já arquivados."""
+    cursor.execute("DELETE FROM movimentos_diarios")
+    cursor.executemany(UPSERT_RESUMO_DIARIO, cursor.execute(SELECT_RESUMO_DIARIO).fetchall())
+
+    # Dentro da transação da migração não dá para usar ATTACH: lê cada arquivo à parte
+    if cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'arquivo_periodos'"
+    ).fetchone():
+        for (nome,) in cursor.execute(
+            "SELECT arquivo FROM arquivo_periodos WHERE estado = 'arquivado'"
+        ).fetchall():
+            arquivo = sqlite3.connect(caminho_arquivo(nome))
+            try:
+                linhas = arquivo.execute(SELECT_RESUMO_DIARIO).fetchall()
+            finally:
+                arquivo.close()
+            cursor.executemany(UPSERT_RESUMO_DIARIO, linhas)
+
+
+def preencher_ultimo_id_arquivos(cursor):
+    """Grava o maior id de cada mês já arquivado (migração 9). Arquivo ilegível fica NULL."""
+    for periodo, nome in cursor.execute(
+        "SELECT periodo, arquivo FROM arquivo_periodos WHERE estado = 'arquivado'"
+    ).fetchall():
+        try:
+            arquivo = sqlite3.connect(f"file:{caminho_arquivo(nome)}?mode=ro", uri=True)
+            try:
+                ultimo_id = arquivo.execute("SELECT MAX(id) FROM movimentos").fetchone()[0]
+            finally:
+                arquivo.close()
+        except sqlite3.Error:
+            continue
+        cursor.execute("UPDATE arquivo_periodos SET ultimo_id = ? WHERE periodo = ?", (ultimo_id, periodo))
+
+
+# ================= MIGRAÇÕES DE SCHEMA =================
+# Versão guardada em PRAGMA user_version. Cada passo é um SQL ou uma função(cursor);
+# nunca altere uma migração já publicada — acrescente uma nova ao final.
+MIGRACOES = [
+    (1, "índices de relatórios e consultas de estoque", [
+        "CREATE INDEX IF NOT EXISTS idx_movimentos_tipo_data ON movimentos (tipo, data)",
+        "CREATE INDEX IF NOT EXISTS idx_movimentos_produto_data ON movimentos (produto_id, data)",
+        "CREATE INDEX IF NOT EXISTS idx_entradas_data ON entradas (data)",
+        "CREATE INDEX IF NOT EXISTS idx_entradas_produto_data ON entradas (produto_id, data)",
+        "CREATE INDEX IF NOT EXISTS idx_saidas_data ON saidas (data)",
+        "CREATE INDEX IF NOT EXISTS idx_saidas_produto_data ON saidas (produto_id, data)",
+        "CREATE INDEX IF NOT EXISTS idx_transferencias_data ON transferencias (data)",
+        "CREATE INDEX IF NOT EXISTS idx_transferencias_produto_data ON transferencias (produto_id, data)",
+        "CREATE INDEX IF NOT EXISTS idx_ajustes_saldo_data ON ajustes_saldo (data)",
+        "CREATE INDEX IF NOT EXISTS idx_ajustes_saldo_produto_data ON ajustes_saldo (produto_id, data)",
+        "CREATE INDEX IF NOT EXISTS idx_novos_produtos_produto ON relatorio_novos_produtos (produto_id)",
+        # Listas de produtos ativos ordenadas por nome (formulários)
+        "CREATE INDEX IF NOT EXISTS idx_produtos_ativo_nome ON produtos (ativo, nome)",
+    ]),
+    (2, "agregados de estoque mantidos por triggers", [
+        """
+        CREATE TABLE IF NOT EXISTS estoque_total (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            quantidade REAL NOT NULL DEFAULT 0,
+            peso REAL NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS estoque_por_produto (
+            produto_id INTEGER PRIMARY KEY,
+            quantidade REAL NOT NULL DEFAULT 0,
+            peso REAL NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS estoque_por_setor (
+            setor TEXT PRIMARY KEY,
+            quantidade REAL NOT NULL DEFAULT 0,
+            peso REAL NOT NULL DEFAULT 0
+        )
+        """,
+        # Quantidade de movimentos por tipo (cards do dashboard)
+        """
+        CREATE TABLE IF NOT EXISTS contagem_movimentos (
+            tipo TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_agregados_insert
+        AFTER INSERT ON estoque
+        BEGIN
+            UPDATE estoque_total
+            SET quantidade = quantidade + NEW.quantidade, peso = peso + NEW.peso
+            WHERE id = 1;
+
+            INSERT INTO estoque_por_produto (produto_id, quantidade, peso)
+            VALUES (NEW.produto_id, NEW.quantidade, NEW.peso)
+            ON CONFLICT (produto_id) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso;
+
+            INSERT INTO estoque_por_setor (setor, quantidade, peso)
+            VALUES (NEW.setor, NEW.quantidade, NEW.peso)
+            ON CONFLICT (setor) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_agregados_update
+        AFTER UPDATE OF produto_id, setor, quantidade, peso ON estoque
+        BEGIN
+            UPDATE estoque_total
+            SET quantidade = quantidade - OLD.quantidade + NEW.quantidade,
+                peso = peso - OLD.peso + NEW.peso
+            WHERE id = 1;
+
+            UPDATE estoque_por_produto
+            SET quantidade = quantidade - OLD.quantidade, peso = peso - OLD.peso
+            WHERE produto_id = OLD.produto_id;
+
+            INSERT INTO estoque_por_produto (produto_id, quantidade, peso)
+            VALUES (NEW.produto_id, NEW.quantidade, NEW.peso)
+            ON CONFLICT (produto_id) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso;
+
+            UPDATE estoque_por_setor
+            SET quantidade = quantidade - OLD.quantidade, peso = peso - OLD.peso
+            WHERE setor = OLD.setor;
+
+            INSERT INTO estoque_por_setor (setor, quantidade, peso)
+            VALUES (NEW.setor, NEW.quantidade, NEW.peso)
+            ON CONFLICT (setor) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_agregados_delete
+        AFTER DELETE ON estoque
+        BEGIN
+            UPDATE estoque_total
+            SET quantidade = quantidade - OLD.quantidade, peso = peso - OLD.peso
+            WHERE id = 1;
+
+            UPDATE estoque_por_produto
+            SET quantidade = quantidade - OLD.quantidade, peso = peso - OLD.peso
+            WHERE produto_id = OLD.produto_id;
+
+            UPDATE estoque_por_setor
+            SET quantidade = quantidade - OLD.quantidade, peso = peso - OLD.peso
+            WHERE setor = OLD.setor;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_movimentos_contagem
+        AFTER INSERT ON movimentos
+        BEGIN
+            INSERT INTO contagem_movimentos (tipo, total) VALUES (NEW.tipo, 1)
+            ON CONFLICT (tipo) DO UPDATE SET total = total + 1;
+        END
+        """,
+        recalcular_agregados,
+    ]),
+    (3, "versão do catálogo de produtos (invalidação do cache entre workers)", [
+        """
+        CREATE TABLE IF NOT EXISTS catalogo_versao (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            versao INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO catalogo_versao (id, versao) VALUES (1, 0)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_catalogo_versao_insert
+        AFTER INSERT ON produtos
+        BEGIN
+            UPDATE catalogo_versao SET versao = versao + 1 WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_catalogo_versao_update
+        AFTER UPDATE OF codigo, nome, descricao, tamanho, peso_unitario, ativo ON produtos
+        BEGIN
+            UPDATE catalogo_versao SET versao = versao + 1 WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_catalogo_versao_delete
+        AFTER DELETE ON produtos
+        BEGIN
+            UPDATE catalogo_versao SET versao = versao + 1 WHERE id = 1;
+        END
+        """,
+    ]),
+    (4, "busca de produtos com FTS5", [
+        # Tabela de conteúdo externo: o texto fica só em produtos
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS produtos_fts USING fts5(
+            codigo, nome, descricao,
+            content = 'produtos',
+            content_rowid = 'id',
+            tokenize = "unicode61 remove_diacritics 2",
+            prefix = '2 3'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_fts_insert
+        AFTER INSERT ON produtos
+        BEGIN
+            INSERT INTO produtos_fts (rowid, codigo, nome, descricao)
+            VALUES (NEW.id, NEW.codigo, NEW.nome, NEW.descricao);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_fts_delete
+        AFTER DELETE ON produtos
+        BEGIN
+            INSERT INTO produtos_fts (produtos_fts, rowid, codigo, nome, descricao)
+            VALUES ('delete', OLD.id, OLD.codigo, OLD.nome, OLD.descricao);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_fts_update
+        AFTER UPDATE OF codigo, nome, descricao ON produtos
+        BEGIN
+            INSERT INTO produtos_fts (produtos_fts, rowid, codigo, nome, descricao)
+            VALUES ('delete', OLD.id, OLD.codigo, OLD.nome, OLD.descricao);
+            INSERT INTO produtos_fts (rowid, codigo, nome, descricao)
+            VALUES (NEW.id, NEW.codigo, NEW.nome, NEW.descricao);
+        END
+        """,
+        "INSERT INTO produtos_fts (produtos_fts) VALUES ('rebuild')",
+    ]),
+    (5, "livro único: tabelas por tipo viram views sobre movimentos", [
+        unificar_livro_movimentos,
+        *[f"DROP TABLE {tabela}" for tabela in TABELAS_POR_TIPO],
+        *[f"CREATE VIEW {tabela} AS {view}" for tabela, (_, _, view) in TABELAS_POR_TIPO.items()],
+        # Totais por produto do dashboard: varredura só das linhas do tipo, sem ler a tabela
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimentos_entrada_produto
+        ON movimentos (produto_id, quantidade) WHERE tipo = 'entrada'
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimentos_saida_produto
+        ON movimentos (produto_id, quantidade) WHERE tipo = 'saida'
+        """,
+    ]),
+    (6, "snapshots de estoque para saldo em data", [
+        # ultimo_movimento_id: o snapshot reflete exatamente os movimentos até esse id
+        """
+        CREATE TABLE IF NOT EXISTS estoque_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data TEXT NOT NULL,
+            ultimo_movimento_id INTEGER NOT NULL,
+            itens INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_estoque_snapshots_data ON estoque_snapshots (data)",
+        # Só pares com saldo diferente de zero
+        """
+        CREATE TABLE IF NOT EXISTS estoque_snapshot_itens (
+            snapshot_id INTEGER NOT NULL REFERENCES estoque_snapshots (id) ON DELETE CASCADE,
+            produto_id INTEGER NOT NULL,
+            setor TEXT NOT NULL,
+            quantidade REAL NOT NULL,
+            peso REAL NOT NULL,
+            PRIMARY KEY (snapshot_id, produto_id, setor)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (7, "arquivo mensal de movimentos", [
+        # Controle do arquivamento: um registro por mês (AAAA-MM)
+        """
+        CREATE TABLE IF NOT EXISTS arquivo_periodos (
+            periodo TEXT PRIMARY KEY,
+            arquivo TEXT NOT NULL,
+            estado TEXT NOT NULL CHECK (estado IN ('copiando', 'arquivado')),
+            movimentos INTEGER NOT NULL DEFAULT 0,
+            contagem TEXT NOT NULL DEFAULT '{}',
+            atualizado_em TEXT
+        )
+        """,
+        # Efeito líquido de todos os movimentos arquivados, por (produto, setor)
+        """
+        CREATE TABLE IF NOT EXISTS saldos_arquivados (
+            produto_id INTEGER NOT NULL,
+            setor TEXT NOT NULL,
+            quantidade REAL NOT NULL DEFAULT 0,
+            peso REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (produto_id, setor)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (8, "resumo diário de movimentos (séries e rankings do dashboard)", [
+        """
+        CREATE TABLE IF NOT EXISTS movimentos_diarios (
+            dia TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            produto_id INTEGER NOT NULL,
+            setor TEXT NOT NULL,
+            movimentos INTEGER NOT NULL DEFAULT 0,
+            quantidade REAL NOT NULL DEFAULT 0,
+            peso REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, tipo, produto_id, setor)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_movimentos_diarios
+        AFTER INSERT ON movimentos
+        BEGIN
+            INSERT INTO movimentos_diarios (dia, tipo, produto_id, setor, movimentos, quantidade, peso)
+            VALUES (
+                COALESCE(substr(NEW.data, 1, 10), date('now', 'localtime')),
+                NEW.tipo,
+                NEW.produto_id,
+                COALESCE(NEW.de_setor, NEW.para_setor, ''),
+                1,
+                COALESCE(NEW.quantidade, 0),
+                COALESCE(NEW.peso, 0)
+            )
+            ON CONFLICT (dia, tipo, produto_id, setor) DO UPDATE SET
+                movimentos = movimentos + 1,
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso;
+        END
+        """,
+        preencher_movimentos_diarios,
+    ]),
+    (9, "saldo em data: replay por id a partir do snapshot", [
+        # A data do movimento é gravada antes do lock: id e data não crescem juntos
+        "CREATE INDEX IF NOT EXISTS idx_movimentos_produto_id ON movimentos (produto_id, id)",
+        # Maior id de cada mês arquivado (NULL nos meses arquivados antes desta versão)
+        "ALTER TABLE arquivo_periodos ADD COLUMN ultimo_id INTEGER",
+        preencher_ultimo_id_arquivos,
+    ]),
+    (10, "versão dos dados das APIs JSON (ETag)", [
+        # Muda a cada escrita no estoque, inclusive as que não geram movimento
+        # (correção da reconciliação, recálculo dos agregados)
+        """
+        CREATE TABLE IF NOT EXISTS dados_versao (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            versao INTEGER NOT NULL DEFAULT 0,
+            atualizado_em TEXT  -- UTC
+        )
+        """,
+        "INSERT OR IGNORE INTO dados_versao (id, versao) VALUES (1, 0)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_estoque_insert
+        AFTER INSERT ON estoque
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_estoque_update
+        AFTER UPDATE ON estoque
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_estoque_delete
+        AFTER DELETE ON estoque
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+        # recalcular_agregados reescreve os agregados sem tocar em estoque
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_agregado_insert
+        AFTER INSERT ON estoque_por_produto
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_agregado_delete
+        AFTER DELETE ON estoque_por_produto
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+    ]),
+    (11, "resumo diário por produto (totais do dashboard a cada movimento)", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimentos_diarios_produto
+        ON movimentos_diarios (produto_id, tipo, dia)
+        """,
+    ]),
+    (12, "versão dos dados também muda com nome de usuário (relatórios)", [
+        # Os relatórios mostram o nome de quem registrou o movimento
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_usuario_update
+        AFTER UPDATE OF nome ON usuarios
+        WHEN OLD.nome IS NOT NEW.nome
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_dados_versao_usuario_delete
+        AFTER DELETE ON usuarios
+        BEGIN
+            UPDATE dados_versao SET versao = versao + 1, atualizado_em = datetime('now') WHERE id = 1;
+        END
+        """,
+    ]),
+]
+
+
+def migrar_banco(conn):
+    """
+    Aplica as migrações pendentes, uma transação por versão, e roda ANALYZE
+    se algo mudou. Seguro com vários workers: a versão é relida sob BEGIN IMMEDIATE.
+    Retorna a versão final do schema.
+    """
+    aplicou = False
+    cursor = conn.cursor()
+
+    for versao, descricao, passos in MIGRACOES:
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= versao:
+            continue
+
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Outro worker pode ter aplicado enquanto esperávamos o lock
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= versao:
+                conn.rollback()
+                continue
+
+            for passo in passos:
+                if callable(passo):
+                    passo(cursor)
+                else:
+                    cursor.execute(passo)
+
+            cursor.execute(f"PRAGMA user_version = {int(versao)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        aplicou = True
+        print(f"🔧 Migração {versao} aplicada: {descricao}")
+
+    if aplicou:
+        cursor.execute("ANALYZE")
+        conn.commit()
+
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
 
 # ================= FUNÇÃO PARA REGISTRAR MOVIMENTOS =================
-def conectar():
-    import sqlite3
-    # Timeout de 10s e permite múltiplas threads (Flask)
-    db = sqlite3.connect("banco.db", timeout=10, check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    return db
+TIPOS_MOVIMENTO = ('novo', 'entrada', 'saida', 'transferencia', 'ajuste')
+
+def debitar_estoque(cursor, produto_id, setor, quantidade, peso, data, mensagem="Saldo insuficiente"):
+    """
+    Debita o saldo num único UPDATE condicionado ao saldo disponível:
+    não há janela entre a verificação e a escrita. Levanta ValueError se faltar saldo.
+    """
+    saldo = cursor.execute("""
+        UPDATE estoque
+        SET quantidade = quantidade - ?, peso = peso - ?, atualizado_em = ?
+        WHERE produto_id = ? AND setor = ? AND quantidade >= ? AND peso >= ?
+        RETURNING quantidade, peso
+    """, (quantidade, peso, data, produto_id, setor, quantidade, peso)).fetchone()
+
+    if saldo is None:
+        # Só no caminho de erro: consulta o disponível para a mensagem
+        atual = cursor.execute("""
+            SELECT quantidade FROM estoque WHERE produto_id = ? AND setor = ?
+        """, (produto_id, setor)).fetchone()
+        raise ValueError(f"{mensagem} (disponível: {atual['quantidade'] if atual else 0})")
+
+    return {"setor": setor, "quantidade": saldo["quantidade"], "peso": saldo["peso"]}
+
+
+def creditar_estoque(cursor, produto_id, setor, quantidade, peso, data):
+    """Credita o saldo com um upsert: cria a linha de estoque se ainda não existir."""
+    saldo = cursor.execute("""
+        INSERT INTO estoque (produto_id, setor, quantidade, peso, atualizado_em)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (produto_id, setor) DO UPDATE SET
+            quantidade = quantidade + excluded.quantidade,
+            peso = peso + excluded.peso,
+            atualizado_em = excluded.atualizado_em
+        RETURNING quantidade, peso
+    """, (produto_id, setor, quantidade, peso, data)).fetchone()
+
+    return {"setor": setor, "quantidade": saldo["quantidade"], "peso": saldo["peso"]}
 
 
 def registrar_movimento(db, tipo, produto_id, setor_origem=None, setor_destino=None,
@@ -199,116 +1323,389 @@ def registrar_movimento(db, tipo, produto_id, setor_origem=None, setor_destino=N
     Parâmetros:
     - db: conexão SQLite aberta (passada da view Flask)
     - tipo: 'novo', 'entrada', 'saida', 'transferencia', 'ajuste'
-    """
-    from datetime import datetime
 
+    Sem transação aberta, roda sob BEGIN IMMEDIATE e faz o commit.
+    Dentro de uma transação do chamador (ex.: novo_produto), usa um SAVEPOINT
+    e deixa o commit para o chamador. Em erro nada do movimento é gravado.
+    """
     if quantidade < 0 or peso < 0:
         raise ValueError("Quantidade e peso devem ser positivos")
+    if tipo not in TIPOS_MOVIMENTO:
+        raise ValueError(f"Tipo de movimento inválido: {tipo}")
 
     data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     cursor = db.cursor()
     saldos_atualizados = []
+    aninhado = db.in_transaction
 
-    # ===== FUNÇÃO AUXILIAR PARA ATUALIZAR ESTOQUE =====
-    def atualizar_estoque(produto_id, setor, quantidade, peso):
-        cursor.execute("""
-            SELECT quantidade, peso FROM estoque
-            WHERE produto_id = ? AND setor = ?
-        """, (produto_id, setor))
-        saldo = cursor.fetchone()
-
-        if saldo:
-            nova_quantidade = saldo["quantidade"] + quantidade
-            novo_peso = saldo["peso"] + peso
-            cursor.execute("""
-                UPDATE estoque
-                SET quantidade = ?, peso = ?, atualizado_em = ?
-                WHERE produto_id = ? AND setor = ?
-            """, (nova_quantidade, novo_peso, data, produto_id, setor))
-        else:
-            nova_quantidade = quantidade
-            novo_peso = peso
-            cursor.execute("""
-                INSERT INTO estoque (produto_id, setor, quantidade, peso, atualizado_em)
-                VALUES (?, ?, ?, ?, ?)
-            """, (produto_id, setor, quantidade, peso, data))
-
-        return {"setor": setor, "quantidade": nova_quantidade, "peso": novo_peso}
+    # BEGIN IMMEDIATE pega o lock de escrita já no início: sem deadlock de upgrade
+    cursor.execute("SAVEPOINT registrar_movimento" if aninhado else "BEGIN IMMEDIATE")
 
     # ===== REGISTRO DE MOVIMENTO =====
     try:
-        if tipo == 'novo':
-            cursor.execute("""
-                INSERT INTO relatorio_novos_produtos (produto_id, setor, usuario_id, data)
-                VALUES (?, ?, ?, ?)
-            """, (produto_id, setor_destino, usuario_id, data))
-            saldos_atualizados.append(atualizar_estoque(produto_id, setor_destino, quantidade, peso))
-
-        elif tipo == 'entrada':
-            cursor.execute("""
-                INSERT INTO entradas (produto_id, setor, quantidade, peso, usuario_id, data)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (produto_id, setor_destino, quantidade, peso, usuario_id, data))
-            saldos_atualizados.append(atualizar_estoque(produto_id, setor_destino, quantidade, peso))
+        if tipo in ('novo', 'entrada', 'ajuste'):
+            saldos_atualizados.append(creditar_estoque(cursor, produto_id, setor_destino, quantidade, peso, data))
 
         elif tipo == 'saida':
-            cursor.execute("""
-                SELECT quantidade, peso FROM estoque
-                WHERE produto_id = ? AND setor = ?
-            """, (produto_id, setor_origem))
-            saldo = cursor.fetchone()
-            if not saldo or saldo["quantidade"] < quantidade or saldo["peso"] < peso:
-                raise ValueError("Saldo insuficiente para saída")
-
-            cursor.execute("""
-                INSERT INTO saidas (produto_id, setor, quantidade, peso, usuario_id, data)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (produto_id, setor_origem, quantidade, peso, usuario_id, data))
-            saldos_atualizados.append(atualizar_estoque(produto_id, setor_origem, -quantidade, -peso))
+            saldos_atualizados.append(debitar_estoque(
+                cursor, produto_id, setor_origem, quantidade, peso, data,
+                "Saldo insuficiente para saída"
+            ))
 
         elif tipo == 'transferencia':
-            cursor.execute("""
-                SELECT quantidade, peso FROM estoque
-                WHERE produto_id = ? AND setor = ?
-            """, (produto_id, setor_origem))
-            saldo = cursor.fetchone()
-            if not saldo or saldo["quantidade"] < quantidade or saldo["peso"] < peso:
-                raise ValueError("Saldo insuficiente para transferência")
-
-            cursor.execute("""
-                INSERT INTO transferencias (produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (produto_id, setor_origem, setor_destino, quantidade, peso, usuario_id, data))
-
-            saldos_atualizados.append(atualizar_estoque(produto_id, setor_origem, -quantidade, -peso))
-            saldos_atualizados.append(atualizar_estoque(produto_id, setor_destino, quantidade, peso))
-
-        elif tipo == 'ajuste':
-            cursor.execute("""
-                INSERT INTO ajustes_saldo (produto_id, setor, quantidade, peso, usuario_id, data)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (produto_id, setor_destino, quantidade, peso, usuario_id, data))
-            saldos_atualizados.append(atualizar_estoque(produto_id, setor_destino, quantidade, peso))
-
-        else:
-            raise ValueError(f"Tipo de movimento inválido: {tipo}")
+            saldos_atualizados.append(debitar_estoque(
+                cursor, produto_id, setor_origem, quantidade, peso, data,
+                "Saldo insuficiente para transferência"
+            ))
+            saldos_atualizados.append(creditar_estoque(cursor, produto_id, setor_destino, quantidade, peso, data))
 
-        # ===== REGISTRO NO LOG GERAL =====
+        # ===== REGISTRO NO LIVRO DE MOVIMENTOS (único) =====
         cursor.execute("""
             INSERT INTO movimentos (tipo, produto_id, de_setor, para_setor,
                                     quantidade, peso, usuario_id, data)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, (tipo, produto_id, setor_origem, setor_destino, quantidade, peso, usuario_id, data))
 
-        db.commit()
+        if aninhado:
+            cursor.execute("RELEASE registrar_movimento")
+        else:
+            db.commit()
+
+    except Exception:
+        if aninhado:
+            cursor.execute("ROLLBACK TO registrar_movimento")
+            cursor.execute("RELEASE registrar_movimento")
+        else:
+            db.rollback()
+        raise
 
     finally:
         cursor.close()  # garante fechamento do cursor
 
     return saldos_atualizados
 
+
+# ================= ESCRITA AGRUPADA (group commit) =================
+# Opcional (ALMOXARIFADO_ESCRITA_AGRUPADA=1). As rotas de movimento entregam o
+# pedido a uma thread escritora do processo, que aplica vários pedidos numa só
+# transação — cada um no seu SAVEPOINT, via registrar_movimento aninhado — e
+# faz um único commit. Quem pediu espera o próprio resultado (ou erro) num Future.
+ESCRITA_AGRUPADA = os.environ.get("ALMOXARIFADO_ESCRITA_AGRUPADA", "0") == "1"
+ESCRITA_GRUPO_MAX = int(os.environ.get("ALMOXARIFADO_ESCRITA_GRUPO_MAX", 64))
+# Quanto o escritor espera por mais pedidos depois do primeiro (ms)
+ESCRITA_GRUPO_ESPERA = float(os.environ.get("ALMOXARIFADO_ESCRITA_GRUPO_ESPERA_MS", 2)) / 1000
+# Quanto a rota espera pelo escritor antes de desistir (s); acima do busy_timeout
+ESCRITA_TIMEOUT = float(os.environ.get("ALMOXARIFADO_ESCRITA_TIMEOUT", 30))
+
+
+class EscritaIndisponivel(Exception):
+    """O escritor agrupado não respondeu (ou não conseguiu abrir o banco)."""
+
+
+class EscritorAgrupado:
+    """Fila de movimentos + thread escritora, criada no primeiro uso de cada processo."""
+
+    def __init__(self):
+        self._fila = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _garantir_thread(self):
+        # Chamado com self._lock. Após o fork do gunicorn a thread do pai não
+        # existe no filho; _pid None indica que a thread anterior morreu
+        if self._pid != os.getpid():
+            self._fila = queue.Queue()
+            threading.Thread(
+                target=self._executar, args=(self._fila,),
+                name="escritor-movimentos", daemon=True
+            ).start()
+            self._pid = os.getpid()
+
+    def enviar(self, **movimento):
+        """Enfileira os argumentos de registrar_movimento e devolve o Future do resultado."""
+        futuro = Future()
+        # Sob o lock: nenhum pedido entra na fila de uma thread que já desistiu
+        with self._lock:
+            self._garantir_thread()
+            self._fila.put((movimento, futuro))
+        return futuro
+
+    def _coletar(self, fila):
+        pedidos = [fila.get()]
+        prazo = time.monotonic() + ESCRITA_GRUPO_ESPERA
+        while len(pedidos) < ESCRITA_GRUPO_MAX:
+            restante = prazo - time.monotonic()
+            try:
+                pedidos.append(fila.get(timeout=restante) if restante > 0 else fila.get_nowait())
+            except queue.Empty:
+                break
+        return pedidos
+
+    def _executar(self, fila):
+        _contexto_metricas.endpoint = "escritor_agrupado"
+        try:
+            conn = conectar()
+        except Exception as e:
+            # Marca a thread como morta (o próximo pedido cria outra) e
+            # devolve o erro a todos que já estavam na fila
+            with self._lock:
+                if self._fila is fila:
+                    self._pid = None
+                pendentes = []
+                while not fila.empty():
+                    pendentes.append(fila.get_nowait())
+            erro = EscritaIndisponivel(f"Não foi possível abrir o banco para gravar: {e}")
+            for _, futuro in pendentes:
+                if futuro.set_running_or_notify_cancel():
+                    futuro.set_exception(erro)
+            return
+
+        while True:
+            self._aplicar(conn, self._coletar(fila))
+
+    def _aplicar(self, conn, pedidos):
+        # Pedidos cancelados por timeout da rota não são gravados
+        pedidos = [(movimento, futuro) for movimento, futuro in pedidos
+                   if futuro.set_running_or_notify_cancel()]
+        if not pedidos:
+            return
+
+        resultados = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for movimento, futuro in pedidos:
+                # Erro de um pedido (ex.: saldo insuficiente) desfaz só o SAVEPOINT dele
+                try:
+                    resultados.append((futuro, registrar_movimento(conn, **movimento), None))
+                except Exception as e:
+                    resultados.append((futuro, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, futuro in pedidos:
+                futuro.set_exception(e)
+            return
+
+        for futuro, resultado, erro in resultados:
+            if erro is not None:
+                futuro.set_exception(erro)
+            else:
+                futuro.set_result(resultado)
+
+
+_escritor = EscritorAgrupado()
+
+
+def gravar_movimento(db, tipo, **campos):
+    """
+    Ponto de entrada das rotas: registrar_movimento direto na conexão da
+    requisição ou, com a escrita agrupada ligada, pela fila do escritor.
+    Mesmo retorno e mesmas exceções nos dois caminhos, mais EscritaIndisponivel
+    se o escritor não responder em ESCRITA_TIMEOUT.
+    """
+    if not ESCRITA_AGRUPADA:
+        return registrar_movimento(db, tipo, **campos)
+
+    futuro = _escritor.enviar(tipo=tipo, **campos)
+    try:
+        return futuro.result(timeout=ESCRITA_TIMEOUT)
+    except FuturoTimeout:
+        if futuro.cancel():
+            raise EscritaIndisponivel("Tempo esgotado: o movimento não foi registrado, tente novamente.")
+        # Já em gravação: o resultado ainda pode ser confirmado
+        raise EscritaIndisponivel("Tempo esgotado: confira o relatório antes de repetir o movimento.")
+
+
+@app.errorhandler(EscritaIndisponivel)
+def tratar_escrita_indisponivel(erro):
+    if request.path.startswith('/api/'):
+        return jsonify({"erro": str(erro)}), 503
+    flash(str(erro), 'danger')
+    return redirect(request.referrer or url_for('dashboard'))
+
  
+# ================= COMPRESSÃO E CACHE HTTP =================
+# Tablets do almoxarifado em Wi-Fi lento: respostas de texto vão comprimidas
+# (brotli se o pacote estiver instalado, senão gzip), arquivos estáticos têm a
+# URL versionada pelo conteúdo (?v=<hash>) e cache imutável, e as APIs JSON
+# respondem 304 enquanto os dados não mudam.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSAO_MIN_BYTES = int(os.environ.get("ALMOXARIFADO_COMPRESSAO_MIN_BYTES", 1024))
+COMPRESSAO_TIPOS = {
+    "text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml",
+}
+ESTATICO_MAX_AGE = 365 * 24 * 3600
+
+_hashes_estaticos = {}
+_hashes_estaticos_lock = threading.Lock()
+
+
+def hash_estatico(nome):
+    """Hash curto do conteúdo do arquivo estático (recalculado se o arquivo mudar)."""
+    caminho = safe_join(app.static_folder, nome)
+    try:
+        modificado = os.stat(caminho).st_mtime_ns if caminho else None
+    except OSError:
+        modificado = None
+    if modificado is None:
+        return None
+
+    with _hashes_estaticos_lock:
+        guardado = _hashes_estaticos.get(nome)
+    if guardado and guardado[0] == modificado:
+        return guardado[1]
+
+    with open(caminho, "rb") as arquivo:
+        versao = hashlib.sha256(arquivo.read()).hexdigest()[:12]
+    with _hashes_estaticos_lock:
+        _hashes_estaticos[nome] = (modificado, versao)
+    return versao
+
+
+@app.url_defaults
+def versionar_estaticos(endpoint, values):
+    """url_for('static', filename=...) ganha ?v=<hash do conteúdo>."""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        versao = hash_estatico(values['filename'])
+        if versao:
+            values['v'] = versao
+
+
+def versao_dados(db):
+    """
+    Versão dos dados servidos pelas APIs JSON: muda a cada movimento, a cada
+    alteração no catálogo, a cada snapshot e a cada escrita no estoque, nos
+    agregados ou no nome de um usuário (dados_versao, por trigger). Buscas O(log n).
+    Retorna (etag, data da última escrita em UTC ou None).
+    """
+    linha = db.execute("""
+        SELECT
+            (SELECT COALESCE(MAX(id), 0) FROM movimentos),
+            (SELECT versao FROM catalogo_versao WHERE id = 1),
+            (SELECT COALESCE(MAX(id), 0) FROM estoque_snapshots),
+            (SELECT data FROM movimentos ORDER BY id DESC LIMIT 1),
+            (SELECT versao FROM dados_versao WHERE id = 1),
+            (SELECT atualizado_em FROM dados_versao WHERE id = 1)
+    """).fetchone()
+
+    ultima = None
+    if linha[3]:
+        try:
+            # movimentos.data está no horário local do servidor
+            ultima = datetime.strptime(linha[3], '%Y-%m-%d %H:%M:%S').astimezone(timezone.utc)
+        except ValueError:
+            pass
+    if linha[5]:
+        # Escrita sem movimento (correção, recálculo) também conta para o If-Modified-Since
+        escrita = datetime.strptime(linha[5], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        ultima = max(ultima, escrita) if ultima else escrita
+    return f"dados-{linha[0]}-{linha[1]}-{linha[2]}-{linha[4]}", ultima
+
+
+def json_condicional(validar=None):
+    """
+    GET condicional (ETag / Last-Modified) para rotas JSON que só dependem do
+    banco e da querystring: responde 304 sem executar a consulta da rota.
+    `validar(*args, **kwargs)` confere os parâmetros antes do 304 e devolve a
+    resposta de erro (ou None): requisição inválida nunca recebe 304.
+    """
+    def decorador(view):
+        @wraps(view)
+        def decorada(*args, **kwargs):
+            if validar is not None:
+                erro = validar(*args, **kwargs)
+                if erro is not None:
+                    return erro
+
+            etag, ultima = versao_dados(obter_db())
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=ultima):
+                resposta = app.response_class(status=304)
+            else:
+                resposta = app.make_response(view(*args, **kwargs))
+                if resposta.status_code != 200:
+                    return resposta
+
+            resposta.set_etag(etag)
+            if ultima:
+                resposta.last_modified = ultima
+            # O navegador sempre revalida; o 304 evita reenviar o corpo
+            resposta.headers['Cache-Control'] = 'private, no-cache'
+            return resposta
+        return decorada
+    return decorador
+
+
+def codificacao_aceita():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+@app.after_request
+def comprimir_resposta(resposta):
+    if (
+        request.method == 'HEAD'
+        or resposta.status_code != 200
+        or resposta.mimetype not in COMPRESSAO_TIPOS
+        or 'Content-Encoding' in resposta.headers
+        or 'Content-Range' in resposta.headers
+    ):
+        return resposta
+
+    # Estáticos vêm por send_file (direct_passthrough): são pequenos e ficam em
+    # cache imutável, então vale ler e comprimir. Streams (CSV, SSE) passam direto.
+    if resposta.direct_passthrough:
+        if request.endpoint != 'static':
+            return resposta
+        resposta.direct_passthrough = False
+    elif resposta.is_streamed:
+        return resposta
+
+    resposta.vary.add('Accept-Encoding')
+    codificacao = codificacao_aceita()
+    corpo = resposta.get_data()
+    if codificacao is None or len(corpo) < COMPRESSAO_MIN_BYTES:
+        return resposta
+
+    if codificacao == 'br':
+        resposta.set_data(brotli.compress(corpo, quality=5))
+    else:
+        resposta.set_data(gzip.compress(corpo, compresslevel=6))
+    resposta.headers['Content-Encoding'] = codificacao
+
+    # Bytes diferentes da representação original: o ETag passa a ser fraco
+    etag, fraco = resposta.get_etag()
+    if etag and not fraco:
+        resposta.set_etag(etag, weak=True)
+    return resposta
+
+
+@app.after_request
+def cache_estaticos(resposta):
+    """Estático pedido com o hash atual na URL: o navegador não precisa revalidar."""
+    if (
+        request.endpoint == 'static'
+        and resposta.status_code in (200, 304)
+        and request.args.get('v')
+        and request.args.get('v') == hash_estatico(request.view_args.get('filename', ''))
+    ):
+        resposta.cache_control.no_cache = None
+        resposta.cache_control.public = True
+        resposta.cache_control.max_age = ESTATICO_MAX_AGE
+        resposta.cache_control.immutable = True
+    return resposta
+
+
 # ================= DECORATOR LOGIN =================
 def login_required(f):
     @wraps(f)
@@ -329,21 +1726,6 @@ def adm_required(f):
         return f(*args, **kwargs)
     return decorated
 
-# ================= RELATÓRIO: NOVOS PRODUTOS =================
-def registrar_novo_produto_relatorio(cursor, produto):
-    cursor.execute("""
-        INSERT INTO relatorio_novos_produtos
-        (produto_id, nome, setor, quantidade, peso, data)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (
-        produto.id,
-        produto.nome,
-        produto.setor,
-        produto.quantidade,
-        produto.peso,
-        datetime.now()
-    ))
-
 # ================= ROTAS =================
 
 # --- Login ---
@@ -354,12 +1736,11 @@ def login():
         email = request.form['email']
         senha = request.form['senha']
 
-        conn = conectar()
+        conn = obter_db()
         usuario = conn.execute(
             "SELECT * FROM usuarios WHERE email=?",
             (email,)
         ).fetchone()
-        conn.close()
 
         if usuario and check_password_hash(usuario['senha'], senha):
             session['user_id'] = usuario['id']
@@ -392,95 +1773,242 @@ def logout():
     return redirect(url_for('login'))
 
 # --- Dashboard ---
+# Linhas dos modais "maior quantidade / peso" e fatias dos gráficos de pizza
+DASHBOARD_TOP = 20
+DASHBOARD_TOP_GRAFICO = 10
+# Janela dos gráficos de pizza: o ranking lê só os dias recentes do resumo diário
+DASHBOARD_DIAS_GRAFICO = int(os.environ.get("ALMOXARIFADO_DASHBOARD_DIAS", 30))
+
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = conectar()
+    conn = obter_db()
     cursor = conn.cursor()
 
-    # Totais gerais
-    cursor.execute("""
-    SELECT 
-        COALESCE(SUM(e.quantidade), 0) -
-        COALESCE((
-            SELECT SUM(s.quantidade) FROM saidas s
-        ), 0) AS total_qtde
-    FROM entradas e
-    """)
-    total_qtde = cursor.fetchone()["total_qtde"]
-
-    cursor.execute("""
-    SELECT 
-        COALESCE(SUM(e.quantidade * p.peso_unitario), 0) -
-        COALESCE((
-            SELECT SUM(s.quantidade * p.peso_unitario)
-            FROM saidas s
-            JOIN produtos p ON p.id = s.produto_id
-        ), 0) AS total_peso
-    FROM entradas e
-    JOIN produtos p ON p.id = e.produto_id
-    """)
-    total_peso = cursor.fetchone()["total_peso"]
-
-    totais = {
-    "total_qtde": total_qtde,
-    "total_peso": total_peso
-}
-
-    # Todos os produtos
-    produtos = cursor.execute("SELECT * FROM produtos").fetchall()
-
-    # Entradas e saídas
-    entradas = cursor.execute("""
-        SELECT e.*, p.nome FROM entradas e
-        JOIN produtos p ON p.id = e.produto_id
-    """).fetchall()
+    # Totais gerais (agregados mantidos por trigger: uma linha)
+    totais = cursor.execute("""
+        SELECT quantidade AS total_qtde, peso AS total_peso
+        FROM estoque_total
+        WHERE id = 1
+    """).fetchone()
 
-    saidas = cursor.execute("""
-        SELECT s.*, p.nome FROM saidas s
-        JOIN produtos p ON p.id = s.produto_id
-    """).fetchall()
+    # Modais de maior quantidade / peso: só os N primeiros, ordenados no SQL
+    mais_quantidade, mais_peso = (
+        cursor.execute(f"""
+            SELECT p.id, p.nome, a.quantidade, a.peso
+            FROM estoque_por_produto a
+            JOIN produtos p ON p.id = a.produto_id
+            ORDER BY a.{coluna} DESC
+            LIMIT ?
+        """, (DASHBOARD_TOP,)).fetchall()
+        for coluna in ("quantidade", "peso")
+    )
 
-    conn.close()
+    # Quantidade de entradas e saídas registradas
+    contagem = {
+        row["tipo"]: row["total"]
+        for row in cursor.execute("""
+            SELECT tipo, total FROM contagem_movimentos
+            WHERE tipo IN ('entrada', 'saida')
+        """)
+    }
 
     return render_template(
         "dashboard.html",
         totais=totais,
-        produtos=produtos,
-        entradas=entradas,
-        saidas=saidas
+        mais_quantidade=mais_quantidade,
+        mais_peso=mais_peso,
+        top=DASHBOARD_TOP,
+        dias_grafico=DASHBOARD_DIAS_GRAFICO,
+        total_entradas=contagem.get('entrada', 0),
+        total_saidas=contagem.get('saida', 0)
     )
 
+# Máximo de movimentos lidos por ?since=; acima disso o cliente recarrega os agregados
+DASHBOARD_MAX_DELTA = 1000
+
+
+def versao_movimentos(db):
+    """Último id de movimentos: muda a cada movimento registrado (busca O(log n) na PK)."""
+    return db.execute("SELECT COALESCE(MAX(id), 0) FROM movimentos").fetchone()[0]
+
+
+def inicio_janela_grafico():
+    """Primeiro dia (AAAA-MM-DD) da janela dos gráficos do dashboard."""
+    return (datetime.now() - timedelta(days=DASHBOARD_DIAS_GRAFICO - 1)).strftime("%Y-%m-%d")
+
+
+def totais_desde(db, since, de):
+    """
+    Produtos com entrada ou saída de id > since e o total atualizado de cada
+    um na janela que começa em `de`. O cliente substitui (não soma) o total:
+    produto que volta ao ranking entra com a janela inteira, não só com o delta.
+    Lê no máximo DASHBOARD_MAX_DELTA movimentos; acima disso, truncado.
+    """
+    movimentos = db.execute("""
+        SELECT tipo, produto_id
+        FROM movimentos
+        WHERE id > ? AND tipo IN ('entrada', 'saida')
+        ORDER BY id
+        LIMIT ?
+    """, (since, DASHBOARD_MAX_DELTA + 1)).fetchall()
+
+    if len(movimentos) > DASHBOARD_MAX_DELTA:
+        return {"totais": [], "truncado": True}
+
+    tocados = list(dict.fromkeys((m["tipo"], m["produto_id"]) for m in movimentos))
+    if not tocados:
+        return {"totais": [], "truncado": False}
+
+    valores = ", ".join("(?, ?)" for _ in tocados)
+    totais = db.execute(f"""
+        SELECT
+            v.column1 AS tipo,
+            p.id AS produto_id,
+            p.nome,
+            COALESCE(SUM(m.quantidade), 0) AS quantidade
+        FROM (VALUES {valores}) AS v
+        JOIN produtos p ON p.id = v.column2
+        LEFT JOIN movimentos_diarios m
+            ON m.produto_id = v.column2 AND m.tipo = v.column1 AND m.dia >= ?
+        GROUP BY v.column1, p.id
+    """, [*(v for par in tocados for v in par), de]).fetchall()
+
+    return {"totais": [dict(t) for t in totais], "truncado": False}
+
+
 @app.route('/dashboard/dados')
 @login_required
 def dashboard_dados():
-    conn = conectar()
-    cursor = conn.cursor()
+    """
+    Totais de entradas e saídas por produto nos últimos DASHBOARD_DIAS_GRAFICO
+    dias, calculados no SQL.
+    - ETag derivado do último movimento e do início da janela: responde 304 se nada mudou.
+    - ?since=<versao>&de=<início>: devolve só os totais dos produtos movimentados
+      depois dessa versão; se a janela já virou, devolve o ranking da janela nova.
+    """
+    conn = obter_db()
+
+    versao = versao_movimentos(conn)
+    de = inicio_janela_grafico()
+    etag = f"mov-{versao}-{de}"
+
+    # Comparação fraca: com compressão o ETag volta como W/"..."
+    if request.if_none_match.contains_weak(etag):
+        resposta = app.response_class(status=304)
+        resposta.set_etag(etag)
+        return resposta
+
+    since = request.args.get('since', type=int)
+
+    if since is not None and request.args.get('de') == de:
+        dados = totais_desde(conn, since, de)
+        dados["versao"] = versao
+    else:
+        # Produtos mais movimentados na janela, direto do resumo diário (faixa de dia na PK)
+        dados = {
+            "versao": versao,
+            "de": de,
+            "entradas": top_produtos_movimentados(conn, "entrada", de=de, limite=DASHBOARD_TOP_GRAFICO),
+            "saidas": top_produtos_movimentados(conn, "saida", de=de, limite=DASHBOARD_TOP_GRAFICO),
+            "top": DASHBOARD_TOP_GRAFICO,
+        }
+
+    resposta = jsonify(dados)
+    resposta.set_etag(etag)
+    # O navegador sempre revalida; o 304 evita reenviar o corpo
+    resposta.headers['Cache-Control'] = 'private, no-cache'
+    return resposta
+
+# Intervalo de verificação do banco e duração máxima de cada conexão SSE (segundos).
+# Ao fim da duração o navegador reconecta sozinho (EventSource) a partir do Last-Event-ID.
+STREAM_INTERVALO = float(os.environ.get("ALMOXARIFADO_STREAM_INTERVALO", 1))
+STREAM_DURACAO_MAX = float(os.environ.get("ALMOXARIFADO_STREAM_DURACAO_MAX", 300))
+STREAM_HEARTBEAT = 15
+
+# Orçamento de threads: cada stream aberto prende uma thread do worker gthread
+# (Procfile: --threads 8) por até STREAM_DURACAO_MAX. Sem limite, ~8 dashboards
+# abertos travariam todas as outras rotas, inclusive entrada/saída. Acima do
+# limite o stream responde 503 e o dashboard volta ao polling de /dashboard/dados.
+STREAM_MAX_CONEXOES = int(os.environ.get("ALMOXARIFADO_STREAM_MAX_CONEXOES", 2))
+_vagas_stream = threading.BoundedSemaphore(STREAM_MAX_CONEXOES)
+
+
+@app.route('/dashboard/stream')
+@login_required
+def dashboard_stream():
+    """
+    Server-Sent Events: um evento "movimento" por commit em movimentos.
+    Funciona entre workers porque o sinal é o próprio arquivo SQLite:
+    PRAGMA data_version muda quando outra conexão grava, e só então
+    o último id de movimentos é consultado.
+    No máximo STREAM_MAX_CONEXOES streams por processo; acima disso, 503.
+    """
+    if not _vagas_stream.acquire(blocking=False):
+        resposta = jsonify({"erro": "Limite de streams atingido, use /dashboard/dados"})
+        resposta.status_code = 503
+        resposta.headers['Retry-After'] = str(int(STREAM_DURACAO_MAX))
+        return resposta
 
-    entradas = cursor.execute("""
-        SELECT e.*, p.nome FROM entradas e
-        JOIN produtos p ON p.id = e.produto_id
-    """).fetchall()
+    ultimo_evento = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        versao_cliente = int(ultimo_evento) if ultimo_evento else None
+    except ValueError:
+        versao_cliente = None
 
-    saidas = cursor.execute("""
-        SELECT s.*, p.nome FROM saidas s
-        JOIN produtos p ON p.id = s.produto_id
-    """).fetchall()
+    def eventos(versao_enviada):
+        # Conexão própria: o stream vive mais que a requisição e não deve prender o pool
+        conn = conectar()
+        try:
+            if versao_enviada is None:
+                versao_enviada = versao_movimentos(conn)
 
-    conn.close()
+            yield f"retry: 3000\nid: {versao_enviada}\n\n"
 
-    # Converter Row objects para dicts simples
-    entradas_list = [{"nome": e["nome"], "quantidade": e["quantidade"]} for e in entradas]
-    saidas_list = [{"nome": s["nome"], "quantidade": s["quantidade"]} for s in saidas]
+            data_version = None
+            inicio = ultimo_envio = time.monotonic()
 
-    return {"entradas": entradas_list, "saidas": saidas_list}
+            while time.monotonic() - inicio < STREAM_DURACAO_MAX:
+                atual = conn.execute("PRAGMA data_version").fetchone()[0]
+
+                if atual != data_version:
+                    data_version = atual
+                    versao = versao_movimentos(conn)
+
+                    if versao > versao_enviada:
+                        dados = totais_desde(conn, versao_enviada, inicio_janela_grafico())
+                        dados["versao"] = versao
+                        versao_enviada = versao
+                        ultimo_envio = time.monotonic()
+                        yield f"event: movimento\nid: {versao}\ndata: {json.dumps(dados)}\n\n"
+
+                if time.monotonic() - ultimo_envio >= STREAM_HEARTBEAT:
+                    ultimo_envio = time.monotonic()
+                    yield ": ping\n\n"
+
+                time.sleep(STREAM_INTERVALO)
+        finally:
+            conn.close()
+
+    resposta = app.response_class(
+        eventos(versao_cliente),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # desativa buffer de proxy (nginx)
+        }
+    )
+    # call_on_close roda mesmo se o gerador nunca for iniciado (cliente caiu antes)
+    resposta.call_on_close(_vagas_stream.release)
+    return resposta
 
 # ================= ROTAS DE USUÁRIOS =================
 @app.route('/usuarios', methods=['GET', 'POST'])
 @login_required
 @adm_required
 def usuarios():
-    conn = conectar()
+    conn = obter_db()
     cursor = conn.cursor()
 
     if request.method == 'POST':
@@ -507,16 +2035,14 @@ def usuarios():
             flash("Email ou CPF já cadastrado!", "danger")
 
     usuarios = cursor.execute("SELECT * FROM usuarios").fetchall()
-    conn.close()
     return render_template("usuarios.html", usuarios=usuarios)
 
 @app.route('/usuarios')
 def listar_usuarios():
-    conn = conectar()
+    conn = obter_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id, nome, usuario, nivel FROM usuarios")
     usuarios = cursor.fetchall()
-    conn.close()
     return render_template('usuarios.html', usuarios=usuarios)
 
 
@@ -524,7 +2050,7 @@ def listar_usuarios():
 @login_required
 @adm_required
 def editar_usuario(id):
-    conn = conectar()
+    conn = obter_db()
     cursor = conn.cursor()
 
     # Pega os dados atuais do usuário
@@ -533,7 +2059,6 @@ def editar_usuario(id):
 
     if not usuario:
         flash("Usuário não encontrado.", "danger")
-        conn.close()
         return redirect(url_for('usuarios'))
 
     if request.method == 'POST':
@@ -549,12 +2074,10 @@ def editar_usuario(id):
             WHERE id = ?
         """, (nome, email, cpf, perfil, id))
         conn.commit()
-        conn.close()
 
         flash("Usuário atualizado com sucesso!", "success")
         return redirect(url_for('usuarios'))
 
-    conn.close()
     return render_template('editar_usuario.html', usuario={
         'id': usuario['id'],
         'nome': usuario['nome'],
@@ -567,10 +2090,15 @@ def editar_usuario(id):
 @login_required
 @adm_required
 def excluir_usuario(usuario_id):
-    conn = conectar()
-    conn.execute("DELETE FROM usuarios WHERE id=?", (usuario_id,))
-    conn.commit()
-    conn.close()
+    conn = obter_db()
+    try:
+        conn.execute("DELETE FROM usuarios WHERE id=?", (usuario_id,))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # foreign_keys = ON: usuário com movimentos registrados não pode ser apagado
+        conn.rollback()
+        flash("Usuário possui movimentações registradas e não pode ser excluído.", "danger")
+        return redirect(url_for('usuarios'))
     flash("Usuário excluído com sucesso!", "success")
     return redirect(url_for('usuarios'))
 
@@ -595,7 +2123,7 @@ def novo_produto():
             flash("Preencha todos os campos obrigatórios.", "warning")
             return redirect(url_for('novo_produto'))
 
-        db = conectar()
+        db = obter_db()
         cursor = db.cursor()
 
         # 🔹 Verifica código duplicado
@@ -628,12 +2156,250 @@ def novo_produto():
 
     return render_template('novo_produto.html')
 
-# --- Entrada ---
-@app.route('/entrada', methods=['GET', 'POST'])
+# --- Importação de Produtos (ADM) ---
+IMPORTACAO_TAMANHO_LOTE = 1000
+IMPORTACAO_COLUNAS = ('codigo', 'nome', 'descricao', 'tamanho', 'peso_unitario', 'setor', 'quantidade')
+
+
+def ler_linhas_importacao(arquivo, nome_arquivo):
+    """
+    Gera (número da linha, dict) de um CSV ou XLSX sem carregar o arquivo inteiro.
+    A primeira linha é o cabeçalho; colunas fora de IMPORTACAO_COLUNAS são ignoradas.
+    Arquivo ilegível levanta ValueError (UnicodeDecodeError no CSV) ou csv.Error.
+    """
+    if nome_arquivo.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook  # só necessário para planilhas
+        from openpyxl.utils.exceptions import InvalidFileException
+
+        try:
+            planilha = load_workbook(arquivo, read_only=True, data_only=True).active
+        except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError) as e:
+            raise ValueError(f"planilha .xlsx inválida ({e})")
+        linhas = planilha.iter_rows(values_only=True)
+    else:
+        texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+        amostra = texto.read(4096)
+        texto.seek(0)
+        delimitador = ';' if amostra.count(';') > amostra.count(',') else ','
+        linhas = csv.reader(texto, delimiter=delimitador)
+
+    cabecalho = [str(c or '').strip().lower() for c in next(linhas, [])]
+
+    for numero, valores in enumerate(linhas, start=2):
+        if not any(v not in (None, '') for v in valores):
+            continue
+        yield numero, dict(zip(cabecalho, valores))
+
+
+def normalizar_linha_importacao(linha):
+    """Valida uma linha da planilha. Levanta ValueError com a mensagem do erro."""
+    def texto(coluna):
+        valor = linha.get(coluna)
+        return str(valor).strip() if valor is not None else ''
+
+    def numero(coluna):
+        valor = texto(coluna).replace(',', '.')
+        try:
+            return float(valor) if valor else 0.0
+        except ValueError:
+            raise ValueError(f"{coluna} inválido: {valor}")
+
+    codigo, nome = texto('codigo'), texto('nome')
+    if not codigo or not nome:
+        raise ValueError("codigo e nome são obrigatórios")
+
+    peso_unitario, quantidade = numero('peso_unitario'), numero('quantidade')
+    if peso_unitario < 0 or quantidade < 0:
+        raise ValueError("Quantidade e peso devem ser positivos")
+
+    return {
+        "codigo": codigo,
+        "nome": nome,
+        "descricao": texto('descricao'),
+        "tamanho": texto('tamanho'),
+        "peso_unitario": peso_unitario,
+        "setor": texto('setor') or 'Almoxarifado',
+        "quantidade": quantidade,
+    }
+
+
+def importar_lote_produtos(conn, lote, usuario_id, data):
+    """
+    Grava um lote já validado numa transação: upsert de produtos por código e
+    saldo inicial em estoque para (produto, setor) ainda inexistentes.
+    Retorna (produtos novos, produtos atualizados, saldos criados).
+    """
+    cursor = conn.cursor()
+
+    # Código repetido no lote: a última linha vale para o produto, e o peso do
+    # saldo inicial usa o mesmo peso_unitario gravado no produto
+    produtos = {linha["codigo"]: linha for linha in lote}
+    codigos = list(produtos)
+    marcadores = ", ".join("?" for _ in codigos)
+
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        existentes = {
+            row[0] for row in cursor.execute(
+                f"SELECT codigo FROM produtos WHERE codigo IN ({marcadores})", codigos
+            )
+        }
+
+        # UPDATE e INSERT separados: um upsert em tabela AUTOINCREMENT
+        # consumiria um id a cada produto já existente
+        cursor.executemany("""
+            UPDATE produtos
+            SET nome = :nome, descricao = :descricao, tamanho = :tamanho, peso_unitario = :peso_unitario
+            WHERE codigo = :codigo
+        """, [linha for linha in produtos.values() if linha["codigo"] in existentes])
+
+        cursor.executemany("""
+            INSERT INTO produtos (codigo, nome, descricao, tamanho, peso_unitario)
+            VALUES (:codigo, :nome, :descricao, :tamanho, :peso_unitario)
+            ON CONFLICT (codigo) DO UPDATE SET
+                nome = excluded.nome,
+                descricao = excluded.descricao,
+                tamanho = excluded.tamanho,
+                peso_unitario = excluded.peso_unitario
+        """, [linha for linha in produtos.values() if linha["codigo"] not in existentes])
+
+        ids = dict(cursor.execute(
+            f"SELECT codigo, id FROM produtos WHERE codigo IN ({marcadores})", codigos
+        ).fetchall())
+
+        ja_em_estoque = {
+            (row[0], row[1]) for row in cursor.execute(
+                f"SELECT produto_id, setor FROM estoque WHERE produto_id IN ({marcadores})",
+                list(ids.values())
+            )
+        }
+
+        # Saldo inicial só onde ainda não existe (reimportar não duplica estoque)
+        # Mesmo (código, setor) repetido: vale a última linha, como no produto
+        saldos = {}
+        for linha in lote:
+            par = (ids[linha["codigo"]], linha["setor"])
+            if par not in ja_em_estoque:
+                peso_unitario = produtos[linha["codigo"]]["peso_unitario"]
+                saldos[par] = (linha["quantidade"], round(linha["quantidade"] * peso_unitario, 3))
+
+        cursor.executemany("""
+            INSERT INTO estoque (produto_id, setor, quantidade, peso, atualizado_em)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(produto_id, setor, qtd, peso, data) for (produto_id, setor), (qtd, peso) in saldos.items()])
+
+        cursor.executemany("""
+            INSERT INTO movimentos (tipo, produto_id, para_setor, quantidade, peso, usuario_id, data)
+            VALUES ('novo', ?, ?, ?, ?, ?, ?)
+        """, [
+            (produto_id, setor, qtd, peso, usuario_id, data)
+            for (produto_id, setor), (qtd, peso) in saldos.items()
+        ])
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return len(set(codigos) - existentes), len(existentes), len(saldos)
+
+
+def importar_produtos(conn, linhas, usuario_id=None, tamanho_lote=IMPORTACAO_TAMANHO_LOTE):
+    """
+    Importa produtos e saldos iniciais a partir de (número da linha, dict),
+    em transações de `tamanho_lote` linhas. Linhas inválidas não interrompem a carga.
+    Se o próprio arquivo ficar ilegível no meio (ex.: encoding), a leitura para ali:
+    os lotes já gravados ficam, e resumo["interrompido"] diz onde e por quê.
+    Retorna (resumo, erros) onde erros é uma lista de (linha, mensagem).
+    """
+    resumo = {"linhas": 0, "novos": 0, "atualizados": 0, "saldos": 0, "interrompido": None}
+    erros = []
+    lote = []
+    data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def gravar():
+        novos, atualizados, saldos = importar_lote_produtos(conn, lote, usuario_id, data)
+        resumo["novos"] += novos
+        resumo["atualizados"] += atualizados
+        resumo["saldos"] += saldos
+        lote.clear()
+
+    linhas = iter(linhas)
+    numero = 1
+    while True:
+        try:
+            numero, linha = next(linhas)
+        except StopIteration:
+            break
+        except (ValueError, csv.Error) as e:
+            resumo["interrompido"] = f"leitura interrompida após a linha {numero}: {e}"
+            break
+
+        resumo["linhas"] += 1
+        try:
+            lote.append(normalizar_linha_importacao(linha))
+        except ValueError as e:
+            erros.append((numero, str(e)))
+            continue
+
+        if len(lote) >= tamanho_lote:
+            gravar()
+
+    if lote:
+        gravar()
+
+    return resumo, erros
+
+
+@app.route('/importar_produtos', methods=['GET', 'POST'])
+@login_required
+@adm_required
+def importar_produtos_view():
+    resumo, erros = None, []
+
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename.lower().endswith(('.csv', '.xlsx')):
+            flash("Envie um arquivo .csv ou .xlsx.", "warning")
+            return redirect(url_for('importar_produtos_view'))
+
+        try:
+            resumo, erros = importar_produtos(
+                obter_db(),
+                ler_linhas_importacao(arquivo.stream, arquivo.filename),
+                usuario_id=session.get('user_id')
+            )
+        except ImportError as e:
+            flash(f"Não foi possível ler o arquivo: {e}", "danger")
+            return redirect(url_for('importar_produtos_view'))
+
+        if resumo["interrompido"]:
+            # Lotes anteriores ao erro já foram gravados: o usuário precisa saber quantos
+            flash(
+                f"Não foi possível ler o arquivo inteiro ({resumo['interrompido']}). "
+                f"Importado até ali: {resumo['linhas']} linha(s) — {resumo['novos']} produto(s) "
+                f"novo(s), {resumo['atualizados']} atualizado(s), {resumo['saldos']} saldo(s) inicial(is).",
+                "danger"
+            )
+        else:
+            flash(
+                f"✅ {resumo['novos']} produto(s) novo(s), {resumo['atualizados']} atualizado(s), "
+                f"{resumo['saldos']} saldo(s) inicial(is). {len(erros)} linha(s) com erro.",
+                "success" if not erros else "warning"
+            )
+
+    return render_template(
+        'importar_produtos.html',
+        colunas=IMPORTACAO_COLUNAS,
+        resumo=resumo,
+        erros=erros
+    )
+
+# --- Entrada ---
+@app.route('/entrada', methods=['GET', 'POST'])
 @login_required
 def entrada():
-    db = conectar()
-    cursor = db.cursor()
+    db = obter_db()
 
     if request.method == 'POST':
         produto_id = int(request.form['produto_id'])
@@ -643,7 +2409,7 @@ def entrada():
         usuario_id = session.get('user_id')
 
         # 🔹 Registrar movimento de entrada
-        registrar_movimento(
+        gravar_movimento(
             db,
             tipo='entrada',
             produto_id=produto_id,
@@ -653,33 +2419,17 @@ def entrada():
             usuario_id=usuario_id
         )
 
-        db.commit()
         flash('Entrada registrada com sucesso!', 'success')
         return redirect(url_for('entrada'))
 
-    # 🔹 PRODUTOS ATIVOS + ESTOQUE TOTAL
-    produtos = cursor.execute("""
-        SELECT
-            p.id,
-            p.nome,
-            p.codigo,
-            p.peso_unitario,
-            COALESCE(SUM(e.quantidade), 0) AS quantidade_estoque
-        FROM produtos p
-        LEFT JOIN estoque e ON e.produto_id = p.id
-        WHERE p.ativo = 1
-        GROUP BY p.id
-        ORDER BY p.nome
-    """).fetchall()
-
-    return render_template('entrada.html', produtos=produtos)
+    # Produtos e estoque vêm sob demanda da busca (/api/produtos/busca)
+    return render_template('entrada.html')
 
 # --- Saída ---
 @app.route('/saida', methods=['GET', 'POST'])
 @login_required
 def saida():
-    db = conectar()
-    cursor = db.cursor()
+    db = obter_db()
 
     if request.method == 'POST':
         produto_id = int(request.form['produto_id'])
@@ -690,7 +2440,7 @@ def saida():
 
         # 🔹 Registrar movimento de saída
         try:
-            registrar_movimento(
+            gravar_movimento(
                 db,
                 tipo='saida',
                 produto_id=produto_id,
@@ -703,24 +2453,17 @@ def saida():
             flash(str(e), 'danger')
             return redirect(url_for('saida'))
 
-        db.commit()
         flash('Saída registrada com sucesso!', 'success')
         return redirect(url_for('saida'))
 
-    produtos = cursor.execute("""
-        SELECT id, nome, peso_unitario
-        FROM produtos
-        WHERE ativo = 1
-    """).fetchall()
-
-    return render_template('saida.html', produtos=produtos)
+    # 🔹 Produtos são escolhidos por busca (/api/produtos/busca)
+    return render_template('saida.html')
 
 # --- Transferir ---
 @app.route('/transferir', methods=['GET', 'POST'])
 @login_required
 def transferir():
-    db = conectar()
-    cursor = db.cursor()
+    db = obter_db()
     usuario_id = session.get('user_id')
 
     if request.method == 'POST':
@@ -738,197 +2481,464 @@ def transferir():
             flash('Quantidade ou peso inválido.', 'danger')
             return redirect(url_for('transferir'))
 
-        # 🔹 Garantir estoque nos dois setores
-        cursor.execute("""
-            INSERT OR IGNORE INTO estoque (produto_id, setor, quantidade, peso)
-            VALUES (?, ?, 0, 0)
-        """, (produto_id, de_setor))
-        cursor.execute("""
-            INSERT OR IGNORE INTO estoque (produto_id, setor, quantidade, peso)
-            VALUES (?, ?, 0, 0)
-        """, (produto_id, para_setor))
+        # 🔹 Débito condicionado na origem + crédito no destino, numa transação
+        try:
+            gravar_movimento(
+                db=db,
+                tipo='transferencia',
+                produto_id=produto_id,
+                setor_origem=de_setor,
+                setor_destino=para_setor,
+                quantidade=quantidade,
+                peso=peso,
+                usuario_id=usuario_id
+            )
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('transferir'))
 
-        # 🔹 Buscar saldo do setor de origem
-        cursor.execute("""
-            SELECT quantidade, peso
-            FROM estoque
-            WHERE produto_id = ? AND setor = ?
-        """, (produto_id, de_setor))
-        saldo = cursor.fetchone()
+        flash('Transferência realizada com sucesso!', 'success')
+        return redirect(url_for('transferir'))
 
-        if not saldo or saldo['quantidade'] < quantidade:
-            disponivel = saldo['quantidade'] if saldo else 0
-            flash(f"Saldo insuficiente! Disponível: {disponivel}", 'danger')
-            return redirect(url_for('transferir'))
+    # 🔹 Produto escolhido por busca (/api/produtos/busca) e
+    #    estoque buscado sob demanda em /api/produtos/<id>/estoque
+    return render_template('transferir.html')
 
-        # 🔹 Atualizar estoque
-        cursor.execute("""
-            UPDATE estoque
-            SET quantidade = quantidade - ?, peso = peso - ?, atualizado_em = CURRENT_TIMESTAMP
-            WHERE produto_id = ? AND setor = ?
-        """, (quantidade, peso, produto_id, de_setor))
 
-        cursor.execute("""
-            UPDATE estoque
-            SET quantidade = quantidade + ?, peso = peso + ?, atualizado_em = CURRENT_TIMESTAMP
-            WHERE produto_id = ? AND setor = ?
-        """, (quantidade, peso, produto_id, para_setor))
+@app.route('/api/produtos/<int:produto_id>/estoque')
+@login_required
+def api_estoque_produto(produto_id):
+    """Saldos de um produto em cada setor (usado pela tela de transferência)."""
+    saldos = obter_db().execute("""
+        SELECT setor, quantidade, peso
+        FROM estoque
+        WHERE produto_id = ?
+        ORDER BY setor
+    """, (produto_id,)).fetchall()
 
-        # 🔹 Registrar movimentação
-        registrar_movimento(
-            db=db,
-            tipo='transferencia',
-            produto_id=produto_id,
-            setor_origem=de_setor,
-            setor_destino=para_setor,
-            quantidade=quantidade,
-            peso=peso,
-            usuario_id=usuario_id
-        )
+    resposta = jsonify({
+        "produto_id": produto_id,
+        "setores": [dict(s) for s in saldos]
+    })
+    # Curto o bastante para não exibir saldo velho; o ETag evita reenviar o corpo
+    resposta.headers['Cache-Control'] = 'private, max-age=5'
+    resposta.add_etag()
+    return resposta.make_conditional(request)
 
-        db.commit()
-        flash('Transferência realizada com sucesso!', 'success')
-        return redirect(url_for('transferir'))
+PRODUTOS_POR_PAGINA = 50
 
-    # 🔹 GET — produtos ativos
-    produtos = [dict(row) for row in cursor.execute("""
-        SELECT id, nome, peso_unitario
-        FROM produtos
-        WHERE ativo = 1
-        ORDER BY nome
-    """).fetchall()]
 
-    # 🔹 GET — estoque enriquecido com nome e peso_unitario
-    estoque = [dict(row) for row in cursor.execute("""
-        SELECT
-            e.produto_id,
-            e.setor,
-            e.quantidade,
-            e.peso,
-            p.nome AS produto_nome,
-            p.peso_unitario
-        FROM estoque e
-        JOIN produtos p ON p.id = e.produto_id
-    """).fetchall()]
+def ler_cursor_produtos(apos):
+    """Cursor "nome|id" -> (nome, id). O nome pode conter "|": o id é o último campo."""
+    nome, _, ultimo_id = apos.rpartition("|")
+    if not ultimo_id.isdigit():
+        raise ValueError(f"id inválido no cursor: {ultimo_id!r}")
+    return nome, int(ultimo_id)
 
-    db.close()
 
-    return render_template(
-        'transferir.html',
-        produtos=produtos,
-        estoque=estoque
-    )
+def validar_cursor_produtos():
+    if request.args.get('apos'):
+        try:
+            ler_cursor_produtos(request.args['apos'])
+        except ValueError:
+            return jsonify({"erro": "Cursor inválido"}), 400
+    return None
 
-# --- Relatórios ---
-@app.route('/relatorios')
+
+@app.route('/api/produtos')
 @login_required
-def relatorios():
-    db = conectar()
-    cursor = db.cursor()
+@json_condicional(validar=validar_cursor_produtos)
+def api_listar_produtos():
+    """
+    Produtos ativos por nome, com o estoque total, em páginas (?apos=<cursor>&limite).
+    Keyset sobre o índice (ativo, nome): a tabela da tela de entrada carrega uma
+    página por vez em vez do catálogo inteiro.
+    """
+    limite = max(min(request.args.get('limite', PRODUTOS_POR_PAGINA, type=int), 200), 1)
+    condicoes, params = ["p.ativo = 1"], []
+    if request.args.get('apos'):
+        condicoes.append("(p.nome, p.id) > (?, ?)")
+        params.extend(ler_cursor_produtos(request.args['apos']))
 
-    # 🔹 NOVOS PRODUTOS (baseado no movimento "novo")
-    novos_produtos = cursor.execute("""
+    produtos = [dict(row) for row in obter_db().execute(f"""
         SELECT
-            m.id,
-            p.codigo,
+            p.id,
             p.nome,
-            COALESCE(u.nome, 'Não informado') AS usuario_nome,
-            m.data
-        FROM movimentos m
-        JOIN produtos p ON p.id = m.produto_id
-        LEFT JOIN usuarios u ON u.id = m.usuario_id
-        WHERE m.tipo = 'novo'
-        ORDER BY m.data DESC
-    """).fetchall()
+            p.codigo,
+            p.peso_unitario,
+            COALESCE(a.quantidade, 0) AS quantidade_estoque
+        FROM produtos p
+        LEFT JOIN estoque_por_produto a ON a.produto_id = p.id
+        WHERE {" AND ".join(condicoes)}
+        ORDER BY p.nome, p.id
+        LIMIT ?
+    """, (*params, limite + 1)).fetchall()]
 
-    # 🔹 ENTRADAS
-    entradas = cursor.execute("""
-        SELECT
-            e.id,
-            p.nome,
-            e.quantidade,
-            e.peso,
-            COALESCE(u.nome, 'Não informado') AS usuario_nome,
-            e.data
-        FROM entradas e
-        LEFT JOIN produtos p ON e.produto_id = p.id
-        LEFT JOIN usuarios u ON e.usuario_id = u.id
-        ORDER BY e.data DESC
-    """).fetchall()
+    proximo = None
+    if len(produtos) > limite:
+        produtos = produtos[:limite]
+        proximo = f"{produtos[-1]['nome']}|{produtos[-1]['id']}"
 
-    # 🔹 SAÍDAS
-    saidas = cursor.execute("""
-        SELECT
-            s.id,
-            p.nome,
-            s.quantidade,
-            s.peso,
-            COALESCE(u.nome, 'Não informado') AS usuario_nome,
-            s.data
-        FROM saidas s
-        LEFT JOIN produtos p ON s.produto_id = p.id
-        LEFT JOIN usuarios u ON s.usuario_id = u.id
-        ORDER BY s.data DESC
-    """).fetchall()
+    return jsonify({"produtos": produtos, "proximo": proximo})
+
+BUSCA_MAX_RESULTADOS = 50
 
-    # 🔹 TRANSFERÊNCIAS
-    transferencias = cursor.execute("""
+
+def termos_busca_fts(texto):
+    """
+    Converte o texto digitado numa consulta FTS5 de prefixo: cada palavra vira
+    "palavra"* e todas precisam casar. Aspas evitam que a sintaxe FTS vaze.
+    """
+    palavras = re.findall(r"\w+", texto or "")
+    return " ".join(f'"{p}"*' for p in palavras)
+
+
+@app.route('/api/produtos/busca')
+@login_required
+@json_condicional()
+def api_busca_produtos():
+    """
+    Autocomplete: produtos que casam com ?q=, ordenados por relevância (bm25).
+    Só ativos, a menos que ?inativos=1 (filtro de relatórios).
+    """
+    consulta = termos_busca_fts(request.args.get('q'))
+    limite = min(request.args.get('limite', 10, type=int), BUSCA_MAX_RESULTADOS)
+    inativos = request.args.get('inativos') == '1'
+
+    if not consulta:
+        return jsonify({"produtos": []})
+
+    produtos = obter_db().execute("""
         SELECT
-            t.id,
+            p.id,
+            p.codigo,
             p.nome,
-            t.de_setor,
-            t.para_setor,
-            t.quantidade,
-            t.peso,
-            COALESCE(u.nome, 'Não informado') AS usuario_nome,
-            t.data
-        FROM transferencias t
-        LEFT JOIN produtos p ON t.produto_id = p.id
-        LEFT JOIN usuarios u ON t.usuario_id = u.id
-        ORDER BY t.data DESC
-    """).fetchall()
+            p.peso_unitario,
+            COALESCE(a.quantidade, 0) AS quantidade_estoque
+        FROM produtos_fts f
+        JOIN produtos p ON p.id = f.rowid
+        LEFT JOIN estoque_por_produto a ON a.produto_id = p.id
+        WHERE produtos_fts MATCH ? AND (p.ativo = 1 OR ?)
+        ORDER BY bm25(produtos_fts, 10.0, 5.0, 1.0)
+        LIMIT ?
+    """, (consulta, inativos, max(limite, 1))).fetchall()
+
+    return jsonify({"produtos": [dict(p) for p in produtos]})
+
+# --- Relatórios ---
+RELATORIO_POR_PAGINA = 50
+
+# Cada seção é paginada por keyset em (data, id), do mais recente para o mais antigo.
+# "setores" lista as colunas usadas pelo filtro de setor.
+SECOES_RELATORIO = {
+    "novos": {
+        "tabela": "movimentos",
+        "join_produto": "JOIN",
+        "condicao": "x.tipo = 'novo'",
+        "colunas": "x.id, p.codigo, p.nome",
+        "setores": ("x.para_setor",),
+    },
+    "entradas": {
+        "tabela": "movimentos",
+        "join_produto": "LEFT JOIN",
+        "condicao": "x.tipo = 'entrada'",
+        "colunas": "x.id, p.nome, x.para_setor AS setor, x.quantidade, x.peso",
+        "setores": ("x.para_setor",),
+    },
+    "saidas": {
+        "tabela": "movimentos",
+        "join_produto": "LEFT JOIN",
+        "condicao": "x.tipo = 'saida'",
+        "colunas": "x.id, p.nome, x.de_setor AS setor, x.quantidade, x.peso",
+        "setores": ("x.de_setor",),
+    },
+    "transferencias": {
+        "tabela": "movimentos",
+        "join_produto": "LEFT JOIN",
+        "condicao": "x.tipo = 'transferencia'",
+        "colunas": "x.id, p.nome, x.de_setor, x.para_setor, x.quantidade, x.peso",
+        "setores": ("x.de_setor", "x.para_setor"),
+    },
+    "ajustes": {
+        "tabela": "movimentos",
+        "join_produto": "LEFT JOIN",
+        "condicao": "x.tipo = 'ajuste'",
+        "colunas": "x.id, p.nome, x.para_setor AS setor, x.quantidade, x.peso",
+        "setores": ("x.para_setor",),
+    },
+    # Log geral: só exportação e /relatorios/movimentos
+    "movimentos": {
+        "tabela": "movimentos",
+        "join_produto": "LEFT JOIN",
+        "colunas": "x.id, x.tipo, p.nome, x.de_setor, x.para_setor, x.quantidade, x.peso",
+        "setores": ("x.de_setor", "x.para_setor"),
+    },
+}
+
+# Seções exibidas na página /relatorios
+SECOES_PAGINA = ("novos", "entradas", "saidas", "transferencias", "ajustes")
+
+
+def ler_filtros_relatorio(args):
+    """Filtros aceitos na querystring: de, ate (AAAA-MM-DD), setor e produto_id."""
+    return {
+        "de": args.get("de") or None,
+        "ate": args.get("ate") or None,
+        "setor": args.get("setor") or None,
+        "produto_id": args.get("produto_id", type=int),
+    }
 
-    # 🔹 AJUSTES DE SALDO
-    ajustes = cursor.execute("""
+
+def ler_cursor_relatorio(apos):
+    """Cursor "AAAA-MM-DD HH:MM:SS|id" -> (data, id). Levanta ValueError se malformado."""
+    data, _, ultimo_id = apos.rpartition("|")
+    datetime.strptime(data, '%Y-%m-%d %H:%M:%S')
+    if not ultimo_id.isdigit():
+        raise ValueError(f"id inválido no cursor: {ultimo_id!r}")
+    return data, int(ultimo_id)
+
+
+def montar_consulta_secao(secao, filtros, apos=None, limite=None, esquema="main"):
+    """
+    Monta o SELECT de uma seção do relatório com os filtros aplicados no SQL.
+    `apos` é o cursor "data|id" da última linha já exibida; `esquema` escolhe
+    entre o banco principal e um arquivo mensal anexado (ver anexar_periodo).
+    Retorna (sql, parâmetros).
+    """
+    definicao = SECOES_RELATORIO[secao]
+    condicoes = [definicao["condicao"]] if definicao.get("condicao") else []
+    params = []
+
+    if filtros.get("de"):
+        condicoes.append("x.data >= ?")
+        params.append(filtros["de"])
+    if filtros.get("ate"):
+        # date(?, '+1 day') é constante: o índice em data continua sendo usado
+        condicoes.append("x.data < date(?, '+1 day')")
+        params.append(filtros["ate"])
+    if filtros.get("setor"):
+        condicoes.append("(" + " OR ".join(f"{col} = ?" for col in definicao["setores"]) + ")")
+        params.extend([filtros["setor"]] * len(definicao["setores"]))
+    if filtros.get("produto_id"):
+        condicoes.append("x.produto_id = ?")
+        params.append(filtros["produto_id"])
+    if apos:
+        condicoes.append("(x.data, x.id) < (?, ?)")
+        params.extend(ler_cursor_relatorio(apos))
+
+    sql = f"""
         SELECT
-            a.id,
-            p.nome,
-            a.quantidade,
-            a.peso,
+            {definicao["colunas"]},
             COALESCE(u.nome, 'Não informado') AS usuario_nome,
-            a.data
-        FROM ajustes_saldo a
-        LEFT JOIN produtos p ON a.produto_id = p.id
-        LEFT JOIN usuarios u ON a.usuario_id = u.id
-        ORDER BY a.data DESC
-    """).fetchall()
+            x.data
+        FROM {esquema}.{definicao["tabela"]} x
+        {definicao["join_produto"]} main.produtos p ON p.id = x.produto_id
+        LEFT JOIN main.usuarios u ON u.id = x.usuario_id
+        {"WHERE " + " AND ".join(condicoes) if condicoes else ""}
+        ORDER BY x.data DESC, x.id DESC
+    """
+    if limite:
+        sql += " LIMIT ?"
+        params.append(limite)
+
+    return sql, params
+
+
+def pagina_secao(db, secao, filtros, apos=None, limite=RELATORIO_POR_PAGINA):
+    """
+    Retorna (linhas, cursor da próxima página ou None).
+    Lê o banco principal e, se a página não encher, segue pelos arquivos
+    mensais do mais recente para o mais antigo (só os que cruzam o filtro).
+    """
+    linhas = []
+    for periodo in fontes_movimentos(db, filtros.get("de"), filtros.get("ate"), apos):
+        with anexar_periodo(db, periodo) as esquema:
+            sql, params = montar_consulta_secao(secao, filtros, apos, limite + 1 - len(linhas), esquema)
+            linhas += [dict(row) for row in db.execute(sql, params).fetchall()]
+        if len(linhas) > limite:
+            break
+
+    proximo = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo = f"{linhas[-1]['data']}|{linhas[-1]['id']}"
+
+    return linhas, proximo
+
+
+@app.route('/relatorios')
+@login_required
+def relatorios():
+    db = obter_db()
+    cursor = db.cursor()
+    filtros = ler_filtros_relatorio(request.args)
+
+    # 🔹 Primeira página de cada seção; as demais vêm de /relatorios/<secao>
+    secoes = {}
+    for secao in SECOES_PAGINA:
+        linhas, proximo = pagina_secao(db, secao, filtros)
+        secoes[secao] = {"linhas": linhas, "proximo": proximo}
+
+    # 🔹 Produto do filtro atual; os demais vêm da busca (/api/produtos/busca)
+    produto_filtro = None
+    if filtros["produto_id"]:
+        produto_filtro = cursor.execute(
+            "SELECT id, nome FROM produtos WHERE id = ?", (filtros["produto_id"],)
+        ).fetchone()
 
     # 🔹 TOTAIS GERAIS
     totais = cursor.execute("""
-        SELECT
-            COALESCE(SUM(quantidade), 0) AS total_qtde,
-            COALESCE(SUM(peso), 0) AS total_peso
-        FROM estoque
+        SELECT quantidade AS total_qtde, peso AS total_peso
+        FROM estoque_total
+        WHERE id = 1
     """).fetchone()
 
-    db.close()
-
     return render_template(
         'relatorios.html',
-        novos_produtos=novos_produtos,
-        entradas=entradas,
-        saidas=saidas,
-        transferencias=transferencias,
-        ajustes=ajustes,
+        novos_produtos=secoes["novos"]["linhas"],
+        entradas=secoes["entradas"]["linhas"],
+        saidas=secoes["saidas"]["linhas"],
+        transferencias=secoes["transferencias"]["linhas"],
+        ajustes=secoes["ajustes"]["linhas"],
+        proximos={secao: dados["proximo"] for secao, dados in secoes.items()},
+        filtros=filtros,
+        produto_filtro=produto_filtro,
         totais=totais
     )
 
+
+def validar_secao(secao):
+    if secao not in SECOES_RELATORIO:
+        return jsonify({"erro": "Seção inválida"}), 404
+    if request.args.get('apos'):
+        try:
+            ler_cursor_relatorio(request.args['apos'])
+        except ValueError:
+            return jsonify({"erro": "Cursor inválido"}), 400
+    return None
+
+
+@app.route('/relatorios/<secao>')
+@login_required
+@json_condicional(validar=validar_secao)
+def relatorios_secao(secao):
+    """Próxima página de uma seção (JSON), usada pelo botão "Carregar mais"."""
+    limite = min(request.args.get('limite', RELATORIO_POR_PAGINA, type=int), 500)
+    linhas, proximo = pagina_secao(
+        obter_db(),
+        secao,
+        ler_filtros_relatorio(request.args),
+        apos=request.args.get('apos') or None,
+        limite=max(limite, 1)
+    )
+
+    return jsonify({"linhas": linhas, "proximo": proximo})
+
+EXPORTACAO_LINHAS_POR_BLOCO = 500
+
+
+def linhas_exportacao(secao, filtros):
+    """
+    Itera o cursor da seção sem materializar o resultado.
+    Usa conexão própria: a resposta é consumida depois que a view retorna.
+    Gera primeiro o cabeçalho e depois cada linha como tupla, passando pelos
+    arquivos mensais que o filtro de datas alcança.
+    """
+    conn = conectar()
+    try:
+        cabecalho = False
+        for periodo in fontes_movimentos(conn, filtros.get("de"), filtros.get("ate")):
+            with anexar_periodo(conn, periodo) as esquema:
+                sql, params = montar_consulta_secao(secao, filtros, esquema=esquema)
+                cursor = conn.execute(sql, params)
+                # Cliente que desconecta fecha o gerador no meio do cursor: o
+                # cursor precisa ser finalizado antes do DETACH ("database arq is locked")
+                try:
+                    if not cabecalho:
+                        yield tuple(coluna[0] for coluna in cursor.description)
+                        cabecalho = True
+                    for row in cursor:
+                        yield tuple(row)
+                finally:
+                    cursor.close()
+    finally:
+        conn.close()
+
+
+def gerar_csv(linhas):
+    """Converte linhas em blocos de texto CSV (separador ';' para o Excel em pt-BR)."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=';')
+    yield '\ufeff'  # BOM: o Excel reconhece UTF-8 e os acentos
+
+    for numero, linha in enumerate(linhas, start=1):
+        escritor.writerow(linha)
+        if numero % EXPORTACAO_LINHAS_POR_BLOCO == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+@app.route('/relatorios/export')
+@login_required
+def relatorios_export():
+    """
+    Exporta uma seção inteira (com os mesmos filtros de /relatorios) em CSV ou XLSX.
+    CSV sai em streaming; XLSX é escrito em modo write_only num arquivo temporário.
+    Em ambos os casos a memória fica constante, independente do número de linhas.
+    """
+    secao = request.args.get('secao', 'movimentos')
+    formato = request.args.get('formato', 'csv')
+
+    if secao not in SECOES_RELATORIO or formato not in ('csv', 'xlsx'):
+        flash("Seção ou formato de exportação inválido.", "warning")
+        return redirect(url_for('relatorios'))
+
+    filtros = ler_filtros_relatorio(request.args)
+    # de/ate entram no nome do arquivo (Content-Disposition): só datas ISO
+    try:
+        for campo in ("de", "ate"):
+            if filtros[campo]:
+                filtros[campo] = ler_dia(filtros[campo], campo)
+    except ValueError as e:
+        flash(str(e), "warning")
+        return redirect(url_for('relatorios'))
+
+    nome = secure_filename("_".join(filter(None, [secao, filtros["de"], filtros["ate"]])) + f".{formato}")
+
+    if formato == 'csv':
+        return app.response_class(
+            gerar_csv(linhas_exportacao(secao, filtros)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="{nome}"'}
+        )
+
+    from openpyxl import Workbook  # só necessário para planilhas
+
+    livro = Workbook(write_only=True)
+    planilha = livro.create_sheet(secao)
+    for linha in linhas_exportacao(secao, filtros):
+        planilha.append(linha)
+
+    arquivo = tempfile.TemporaryFile()
+    livro.save(arquivo)
+    arquivo.seek(0)
+
+    return send_file(
+        arquivo,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=nome
+    )
+
 # --- Ajustar Saldo (ADM) ---
 @app.route('/ajustar_saldo', methods=['GET', 'POST'])
 @login_required
 @adm_required
 def ajustar_saldo():
-    db = conectar()
+    db = obter_db()
     cursor = db.cursor()
 
     if request.method == 'POST':
@@ -939,7 +2949,7 @@ def ajustar_saldo():
         usuario_id = session.get('user_id')
 
         # 🔹 Registrar movimento de ajuste
-        registrar_movimento(
+        gravar_movimento(
             db,
             tipo='ajuste',
             produto_id=produto_id,
@@ -949,7 +2959,6 @@ def ajustar_saldo():
             usuario_id=usuario_id
         )
 
-        db.commit()
         flash("Saldo ajustado com sucesso!", "success")
 
     produtos = cursor.execute("""
@@ -975,7 +2984,7 @@ def ajustar_saldo():
 def excluir_produto():
     produto_id = int(request.form["produto_id"])
 
-    conn = conectar()
+    conn = obter_db()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -985,7 +2994,6 @@ def excluir_produto():
     """, (produto_id,))
 
     conn.commit()
-    conn.close()
 
     flash("Produto desativado com sucesso!", "success")
     return redirect(url_for("ajustar_saldo"))
@@ -1001,7 +3009,7 @@ def redefinir_senha_usuario():
             flash("Preencha todos os campos.", "warning")
             return redirect(url_for('redefinir_senha_usuario'))
 
-        conn = conectar()
+        conn = obter_db()
         cursor = conn.cursor()
 
         try:
@@ -1034,13 +3042,55 @@ def redefinir_senha_usuario():
             flash("Erro ao redefinir a senha.", "danger")
             return redirect(url_for('redefinir_senha_usuario'))
 
-        finally:
-            conn.close()
-
     # 🔹 GET
     return render_template("redefinir_senha_usuario.html")
-#################################
-from flask import jsonify, request
+# Micro-cache de saldos por processo: vale enquanto o último id de movimentos
+# não mudar, e no máximo SALDO_CACHE_TTL segundos (cobre escritas diretas em estoque)
+SALDO_CACHE_TTL = float(os.environ.get("ALMOXARIFADO_SALDO_CACHE_TTL", 2))
+SALDO_CACHE_MAX = 10000
+SALDO_MAX_PARES = 500
+
+_cache_saldos = {"versao": None, "expira_em": 0, "saldos": {}}
+_cache_saldos_lock = threading.Lock()
+
+
+def consultar_saldos(db, pares):
+    """
+    Quantidade disponível de cada (produto_id, setor) em `pares`.
+    Os pares fora do cache são respondidos por uma única consulta indexada.
+    """
+    versao = versao_movimentos(db)
+    agora = time.monotonic()
+
+    with _cache_saldos_lock:
+        if (_cache_saldos["versao"] != versao or _cache_saldos["expira_em"] <= agora
+                or len(_cache_saldos["saldos"]) > SALDO_CACHE_MAX):
+            _cache_saldos.update(versao=versao, expira_em=agora + SALDO_CACHE_TTL, saldos={})
+        cache = _cache_saldos["saldos"]
+        resultado = {par: cache[par] for par in pares if par in cache}
+
+    faltando = [par for par in dict.fromkeys(pares) if par not in resultado]
+    if faltando:
+        valores = ", ".join("(?, ?)" for _ in faltando)
+        encontrados = {
+            (row["produto_id"], row["setor"]): row["quantidade"]
+            # JOIN com VALUES (e não "(a, b) IN (VALUES ...)") para usar UNIQUE(produto_id, setor)
+            for row in db.execute(f"""
+                SELECT e.produto_id, e.setor, e.quantidade
+                FROM (VALUES {valores}) AS v
+                JOIN estoque e ON e.produto_id = v.column1 AND e.setor = v.column2
+            """, [v for par in faltando for v in par])
+        }
+
+        novos = {par: encontrados.get(par, 0) for par in faltando}
+        resultado.update(novos)
+
+        with _cache_saldos_lock:
+            if _cache_saldos["versao"] == versao:
+                _cache_saldos["saldos"].update(novos)
+
+    return resultado
+
 
 @app.route('/estoque/saldo')
 @login_required
@@ -1051,23 +3101,1089 @@ def estoque_saldo():
     if not produto_id or not setor:
         return jsonify({'quantidade': 0})
 
-    db = conectar()  # sua função de conexão com o banco
+    # Consulta a quantidade disponível no estoque (com micro-cache)
+    quantidade_disponivel = consultar_saldos(obter_db(), [(produto_id, setor)])[(produto_id, setor)]
+
+    return jsonify({'quantidade': quantidade_disponivel})
+
+
+@app.route('/estoque/saldos', methods=['GET', 'POST'])
+@login_required
+def estoque_saldos():
+    """
+    Vários saldos numa requisição.
+    GET  /estoque/saldos?par=1:Almoxarifado&par=2:LPA 01
+    POST {"pares": [{"produto_id": 1, "setor": "Almoxarifado"}, ...]}
+    """
+    try:
+        if request.method == 'POST':
+            corpo = request.get_json(silent=True) or {}
+            # JSON válido de outro formato ([1, 2], "x", pares que não são objetos) também é 400
+            itens = corpo.get('pares', []) if isinstance(corpo, dict) else None
+            if not isinstance(itens, list) or not all(isinstance(p, dict) for p in itens):
+                raise ValueError
+            pares = [(int(p['produto_id']), str(p['setor'])) for p in itens]
+        else:
+            pares = []
+            for valor in request.args.getlist('par'):
+                produto_id, _, setor = valor.partition(':')
+                pares.append((int(produto_id), setor))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"erro": "Pares inválidos"}), 400
+
+    if len(pares) > SALDO_MAX_PARES:
+        return jsonify({"erro": f"Máximo de {SALDO_MAX_PARES} pares por requisição"}), 400
+
+    saldos = consultar_saldos(obter_db(), pares) if pares else {}
+
+    return jsonify({
+        "saldos": [
+            {"produto_id": produto_id, "setor": setor, "quantidade": quantidade}
+            for (produto_id, setor), quantidade in saldos.items()
+        ]
+    })
+
+# ================= API: SÉRIES E RANKINGS (resumo diário) =================
+# Consultas sobre movimentos_diarios: o custo cresce com o número de dias do
+# período, não com o número de movimentos.
+GRANULARIDADES_SERIE = {
+    "dia": "dia",
+    # Segunda-feira da semana (ISO)
+    "semana": "date(dia, '-6 days', 'weekday 1')",
+    "mes": "substr(dia, 1, 7)",
+}
+METRICAS_TOP = ("quantidade", "peso", "movimentos")
+SERIE_DIAS_PADRAO = {"dia": 30, "semana": 7 * 12, "mes": 365}
+TOP_MAX_RESULTADOS = 100
+
+
+def ler_dia(texto, campo):
+    try:
+        return datetime.strptime(texto, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ValueError(f"{campo} inválido (use AAAA-MM-DD)")
+
+
+def filtros_resumo(de=None, ate=None, tipo=None, produto_id=None, setor=None):
+    """Monta o WHERE comum às consultas do resumo diário. Retorna (sql, parâmetros)."""
+    condicoes, params = [], []
+    if de:
+        condicoes.append("m.dia >= ?")
+        params.append(de)
+    if ate:
+        condicoes.append("m.dia <= ?")
+        params.append(ate)
+    if tipo:
+        condicoes.append("m.tipo = ?")
+        params.append(tipo)
+    if produto_id:
+        condicoes.append("m.produto_id = ?")
+        params.append(produto_id)
+    if setor:
+        condicoes.append("m.setor = ?")
+        params.append(setor)
+    return ("WHERE " + " AND ".join(condicoes) if condicoes else ""), params
+
+
+def top_produtos_movimentados(db, tipo, metrica="quantidade", de=None, ate=None,
+                              setor=None, limite=10):
+    """Os `limite` produtos com maior soma de `metrica` no período."""
+    onde, params = filtros_resumo(de, ate, tipo, setor=setor)
+    produtos = db.execute(f"""
+        SELECT
+            p.id AS produto_id,
+            p.codigo,
+            p.nome,
+            SUM(m.movimentos) AS movimentos,
+            SUM(m.quantidade) AS quantidade,
+            SUM(m.peso) AS peso
+        FROM movimentos_diarios m
+        JOIN produtos p ON p.id = m.produto_id
+        {onde}
+        GROUP BY m.produto_id
+        ORDER BY {metrica} DESC, m.produto_id
+        LIMIT ?
+    """, (*params, limite)).fetchall()
+    return [dict(p) for p in produtos]
+
+
+def serie_movimentos(db, granularidade, de, ate, tipo=None, produto_id=None, setor=None):
+    """Totais por período (dia, semana ou mês) e tipo, em ordem cronológica."""
+    periodo = GRANULARIDADES_SERIE[granularidade]
+    onde, params = filtros_resumo(de, ate, tipo, produto_id, setor)
+    pontos = db.execute(f"""
+        SELECT
+            {periodo} AS periodo,
+            m.tipo,
+            SUM(m.movimentos) AS movimentos,
+            SUM(m.quantidade) AS quantidade,
+            SUM(m.peso) AS peso
+        FROM movimentos_diarios m
+        {onde}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """, params).fetchall()
+    return [dict(p) for p in pontos]
+
+
+def validar_periodo_resumo():
+    """Confere ?de= e ?ate= (quando informados) das APIs do resumo diário."""
+    try:
+        for campo in ('de', 'ate'):
+            if request.args.get(campo):
+                ler_dia(request.args[campo], campo)
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    return None
+
+
+def validar_top_movimentos():
+    if request.args.get('tipo', 'saida') not in TIPOS_MOVIMENTO:
+        return jsonify({"erro": f"tipo deve ser um de {', '.join(TIPOS_MOVIMENTO)}"}), 400
+    if request.args.get('metrica', 'quantidade') not in METRICAS_TOP:
+        return jsonify({"erro": f"metrica deve ser uma de {', '.join(METRICAS_TOP)}"}), 400
+    return validar_periodo_resumo()
+
+
+@app.route('/api/movimentos/top')
+@login_required
+@json_condicional(validar=validar_top_movimentos)
+def api_top_movimentos():
+    """?tipo=entrada|saida|...&metrica=quantidade|peso|movimentos&de&ate&setor&limite"""
+    tipo = request.args.get('tipo', 'saida')
+    metrica = request.args.get('metrica', 'quantidade')
+    limite = min(request.args.get('limite', 10, type=int), TOP_MAX_RESULTADOS)
+    de = ler_dia(request.args['de'], 'de') if request.args.get('de') else None
+    ate = ler_dia(request.args['ate'], 'ate') if request.args.get('ate') else None
+
+    produtos = top_produtos_movimentados(
+        obter_db(), tipo, metrica, de, ate, request.args.get('setor') or None, max(limite, 1)
+    )
+    return jsonify({"tipo": tipo, "metrica": metrica, "de": de, "ate": ate, "produtos": produtos})
+
+
+def validar_serie_movimentos():
+    if request.args.get('granularidade', 'dia') not in GRANULARIDADES_SERIE:
+        return jsonify({"erro": "granularidade deve ser dia, semana ou mes"}), 400
+    tipo = request.args.get('tipo')
+    if tipo and tipo not in TIPOS_MOVIMENTO:
+        return jsonify({"erro": f"tipo deve ser um de {', '.join(TIPOS_MOVIMENTO)}"}), 400
+    return validar_periodo_resumo()
+
+
+@app.route('/api/movimentos/serie')
+@login_required
+@json_condicional(validar=validar_serie_movimentos)
+def api_serie_movimentos():
+    """?granularidade=dia|semana|mes&de&ate&tipo&produto_id&setor (padrão: período recente)"""
+    granularidade = request.args.get('granularidade', 'dia')
+    tipo = request.args.get('tipo') or None
+
+    ate = ler_dia(request.args['ate'], 'ate') if request.args.get('ate') \
+        else datetime.now().strftime("%Y-%m-%d")
+    de = ler_dia(request.args['de'], 'de') if request.args.get('de') else (
+        datetime.strptime(ate, "%Y-%m-%d") - timedelta(days=SERIE_DIAS_PADRAO[granularidade] - 1)
+    ).strftime("%Y-%m-%d")
+
+    pontos = serie_movimentos(
+        obter_db(), granularidade, de, ate, tipo,
+        request.args.get('produto_id', type=int), request.args.get('setor') or None
+    )
+    return jsonify({"granularidade": granularidade, "de": de, "ate": ate, "pontos": pontos})
+
+
+# ================= SNAPSHOTS DE ESTOQUE (saldo em data) =================
+# Um snapshot copia o estoque (pares com saldo) junto com o id do último
+# movimento que ele já reflete. O saldo numa data sai do snapshot mais recente
+# até aquela data + os movimentos do produto entre o snapshot e a data, então o
+# custo depende do intervalo entre snapshots, não do histórico inteiro.
+# Agende `flask --app app snapshot-estoque` (ex.: diário) para manter o intervalo curto.
+
+def tirar_snapshot(conn):
+    """Grava um snapshot do estoque atual. Retorna o dict do snapshot criado."""
+    cursor = conn.cursor()
+
+    # BEGIN IMMEDIATE: nenhum movimento entra entre ler o id e copiar o estoque.
+    # A data vem depois do lock, então nenhum movimento já refletido é mais novo que ela
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ultimo_id = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM movimentos").fetchone()[0]
+        snapshot_id = cursor.execute("""
+            INSERT INTO estoque_snapshots (data, ultimo_movimento_id) VALUES (?, ?)
+        """, (data, ultimo_id)).lastrowid
+        itens = cursor.execute("""
+            INSERT INTO estoque_snapshot_itens (snapshot_id, produto_id, setor, quantidade, peso)
+            SELECT ?, produto_id, setor, quantidade, peso
+            FROM estoque
+            WHERE quantidade != 0 OR peso != 0
+        """, (snapshot_id,)).rowcount
+        cursor.execute("UPDATE estoque_snapshots SET itens = ? WHERE id = ?", (itens, snapshot_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {"id": snapshot_id, "data": data, "ultimo_movimento_id": ultimo_id, "itens": itens}
+
+
+def limite_data_saldo(texto):
+    """
+    Converte 'AAAA-MM-DD' (fim do dia) ou 'AAAA-MM-DD HH:MM[:SS]' no limite
+    exclusivo usado nas comparações com movimentos.data.
+    """
+    texto = (texto or "").strip().replace("T", " ")
+    for formato, passo in (("%Y-%m-%d", timedelta(days=1)),
+                           ("%Y-%m-%d %H:%M:%S", timedelta(seconds=1)),
+                           ("%Y-%m-%d %H:%M", timedelta(minutes=1))):
+        try:
+            return (datetime.strptime(texto, formato) + passo).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    raise ValueError("Data inválida (use AAAA-MM-DD ou AAAA-MM-DD HH:MM)")
+
+
+def saldo_em(db, produto_id, setor, data):
+    """
+    Saldo (quantidade, peso) de produto/setor ao fim de `data`.
+    O replay é por id: a data do movimento é gravada antes do BEGIN IMMEDIATE
+    (e a importação usa uma data só para todos os blocos), então um movimento
+    que o snapshot não reflete pode ter data anterior à dele. Vale toda linha
+    com id > ultimo_movimento_id e data < limite, sem limite inferior de data.
+    """
+    limite = limite_data_saldo(data)
+
+    snapshot = db.execute("""
+        SELECT id, data, ultimo_movimento_id
+        FROM estoque_snapshots
+        WHERE data < ?
+        ORDER BY data DESC, id DESC
+        LIMIT 1
+    """, (limite,)).fetchone()
+
+    quantidade = peso = 0.0
+    reaplicados = 0
+    condicoes = ["produto_id = ?", "data < ?", "(de_setor = ? OR para_setor = ?)"]
+    params = [produto_id, limite, setor, setor]
+
+    if snapshot:
+        base = db.execute("""
+            SELECT quantidade, peso FROM estoque_snapshot_itens
+            WHERE snapshot_id = ? AND produto_id = ? AND setor = ?
+        """, (snapshot["id"], produto_id, setor)).fetchone()
+        if base:
+            quantidade, peso = base["quantidade"], base["peso"]
+        condicoes.append("id > ?")
+        params.append(snapshot["ultimo_movimento_id"])
+
+    periodos = fontes_movimentos(db, ate=limite, apos_id=snapshot["ultimo_movimento_id"] if snapshot else None)
+    arquivados = periodos[1:]
+    if not snapshot and arquivados and limite[:7] > arquivados[0]["periodo"]:
+        # Data depois de todo o arquivo: o saldo acumulado dos meses
+        # arquivados substitui a leitura de cada arquivo
+        base = db.execute("""
+            SELECT quantidade, peso FROM saldos_arquivados WHERE produto_id = ? AND setor = ?
+        """, (produto_id, setor)).fetchone()
+        if base:
+            quantidade, peso = base["quantidade"], base["peso"]
+        periodos = periodos[:1]
+
+    for periodo in periodos:
+        with anexar_periodo(db, periodo) as esquema:
+            replay = db.execute(f"""
+                SELECT
+                    COUNT(*) AS movimentos,
+                    COALESCE(SUM(CASE WHEN para_setor = ? THEN quantidade ELSE 0 END), 0)
+                  - COALESCE(SUM(CASE WHEN de_setor = ? THEN quantidade ELSE 0 END), 0) AS quantidade,
+                    COALESCE(SUM(CASE WHEN para_setor = ? THEN peso ELSE 0 END), 0)
+                  - COALESCE(SUM(CASE WHEN de_setor = ? THEN peso ELSE 0 END), 0) AS peso
+                FROM {esquema}.movimentos
+                WHERE {" AND ".join(condicoes)}
+            """, [setor, setor, setor, setor, *params]).fetchone()
+        quantidade += replay["quantidade"]
+        peso += replay["peso"]
+        reaplicados += replay["movimentos"]
+
+    return {
+        "produto_id": produto_id,
+        "setor": setor,
+        "data": data,
+        "quantidade": round(quantidade, 6),
+        "peso": round(peso, 6),
+        "snapshot": dict(snapshot) if snapshot else None,
+        "movimentos_reaplicados": reaplicados,
+    }
+
+
+def validar_saldo_em():
+    if not request.args.get('produto_id', type=int) or not request.args.get('setor') \
+            or not request.args.get('data'):
+        return jsonify({"erro": "Informe produto_id, setor e data"}), 400
+    try:
+        limite_data_saldo(request.args['data'])
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    return None
+
+
+@app.route('/api/estoque/saldo_em')
+@login_required
+@json_condicional(validar=validar_saldo_em)
+def api_saldo_em():
+    return jsonify(saldo_em(
+        obter_db(), request.args.get('produto_id', type=int), request.args['setor'], request.args['data']
+    ))
+
+
+@app.route('/estoque/saldo_em')
+@login_required
+def pagina_saldo_em():
+    db = obter_db()
+    produto_id = request.args.get('produto_id', type=int)
+    setor = request.args.get('setor') or None
+    data = request.args.get('data') or None
+
+    resultado = produto = None
+    if produto_id and setor and data:
+        try:
+            resultado = saldo_em(db, produto_id, setor, data)
+            produto = db.execute(
+                "SELECT id, codigo, nome FROM produtos WHERE id = ?", (produto_id,)
+            ).fetchone()
+        except ValueError as e:
+            flash(str(e), 'danger')
+
+    setores = [row[0] for row in db.execute("SELECT setor FROM estoque_por_setor ORDER BY setor")]
+    snapshots = db.execute("""
+        SELECT id, data, ultimo_movimento_id, itens
+        FROM estoque_snapshots
+        ORDER BY id DESC
+        LIMIT 10
+    """).fetchall()
+
+    return render_template(
+        'saldo_em.html',
+        resultado=resultado,
+        produto=produto,
+        setor=setor,
+        data=data,
+        setores=setores,
+        snapshots=snapshots
+    )
+
+
+# ================= API: MOVIMENTOS EM LOTE =================
+TIPOS_LOTE = ('entrada', 'saida', 'transferencia')
+LOTE_MAX_ITENS = 5000
+
+
+def validar_item_lote(item):
+    """
+    Normaliza um item do lote para (tipo, produto_id, de_setor, para_setor, quantidade, peso).
+    Levanta ValueError com a mensagem para o usuário.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Item deve ser um objeto")
+
+    tipo = item.get('tipo')
+    if tipo not in TIPOS_LOTE:
+        raise ValueError(f"Tipo de movimento inválido: {tipo}")
+
+    try:
+        produto_id = int(item['produto_id'])
+        quantidade = float(item.get('quantidade', 0))
+        peso = float(item.get('peso', 0))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("produto_id, quantidade e peso devem ser numéricos")
+
+    if quantidade <= 0 or peso < 0:
+        raise ValueError("Quantidade ou peso inválido")
+
+    if tipo == 'entrada':
+        de_setor, para_setor = None, item.get('setor')
+    elif tipo == 'saida':
+        de_setor, para_setor = item.get('setor'), None
+    else:
+        de_setor, para_setor = item.get('de_setor'), item.get('para_setor')
+        if de_setor == para_setor:
+            raise ValueError("O setor de origem e destino não podem ser iguais")
+
+    if (tipo != 'entrada' and not de_setor) or (tipo != 'saida' and not para_setor):
+        raise ValueError("Setor não informado")
+
+    return tipo, produto_id, de_setor, para_setor, quantidade, peso
+
+
+@app.route('/api/movimentos/lote', methods=['POST'])
+@login_required
+def api_movimentos_lote():
+    """
+    Registra vários movimentos (entrada, saída, transferência) numa única transação.
+    Corpo: lista de itens, ou {"movimentos": [...]}. Tudo ou nada:
+    os saldos do lote inteiro são validados antes de qualquer escrita.
+    """
+    corpo = request.get_json(silent=True)
+    itens = corpo.get('movimentos') if isinstance(corpo, dict) else corpo
+
+    if not isinstance(itens, list) or not itens:
+        return jsonify({"erro": "Envie uma lista de movimentos"}), 400
+    if len(itens) > LOTE_MAX_ITENS:
+        return jsonify({"erro": f"Máximo de {LOTE_MAX_ITENS} movimentos por lote"}), 400
+
+    movimentos, erros = [], []
+    for indice, item in enumerate(itens):
+        try:
+            movimentos.append(validar_item_lote(item))
+        except ValueError as e:
+            erros.append({"indice": indice, "erro": str(e)})
+
+    if erros:
+        return jsonify({"erros": erros}), 400
+
+    db = obter_db()
     cursor = db.cursor()
+    usuario_id = session.get('user_id')
+    data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    # Consulta a quantidade disponível no estoque
-    cursor.execute("""
-        SELECT SUM(quantidade) as total
-        FROM estoque
-        WHERE produto_id = ? AND setor = ?
-    """, (produto_id, setor))
+    pares = {
+        (produto_id, setor)
+        for _, produto_id, de_setor, para_setor, _, _ in movimentos
+        for setor in (de_setor, para_setor) if setor
+    }
 
-    resultado = cursor.fetchone()
-    quantidade_disponivel = resultado['total'] if resultado['total'] is not None else 0
+    # BEGIN IMMEDIATE: ninguém grava entre a validação e a aplicação do lote
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # 🔹 Saldos atuais de todos os pares do lote, numa consulta só
+        valores = ", ".join("(?, ?)" for _ in pares)
+        saldos = {
+            (row["produto_id"], row["setor"]): [row["quantidade"], row["peso"]]
+            for row in cursor.execute(f"""
+                SELECT e.produto_id, e.setor, e.quantidade, e.peso
+                FROM (VALUES {valores}) AS v
+                JOIN estoque e ON e.produto_id = v.column1 AND e.setor = v.column2
+            """, [v for par in pares for v in par])
+        }
+
+        # 🔹 Simula o lote em ordem para devolver todos os erros de saldo de uma vez
+        for indice, (tipo, produto_id, de_setor, para_setor, quantidade, peso) in enumerate(movimentos):
+            if de_setor:
+                saldo = saldos.get((produto_id, de_setor), [0, 0])
+                if saldo[0] < quantidade or saldo[1] < peso:
+                    erros.append({
+                        "indice": indice,
+                        "erro": f"Saldo insuficiente em {de_setor} (disponível: {saldo[0]})"
+                    })
+                    continue
+                saldos[(produto_id, de_setor)] = [saldo[0] - quantidade, saldo[1] - peso]
+
+            if para_setor:
+                saldo = saldos.get((produto_id, para_setor), [0, 0])
+                saldos[(produto_id, para_setor)] = [saldo[0] + quantidade, saldo[1] + peso]
+
+        if erros:
+            db.rollback()
+            return jsonify({"erros": erros}), 409
+
+        # 🔹 Aplica pelas mesmas regras de registrar_movimento (debitar/creditar_estoque)
+        atualizados = {}
+        for tipo, produto_id, de_setor, para_setor, quantidade, peso in movimentos:
+            if de_setor:
+                saldo = debitar_estoque(cursor, produto_id, de_setor, quantidade, peso, data)
+                atualizados[(produto_id, de_setor)] = saldo
+            if para_setor:
+                saldo = creditar_estoque(cursor, produto_id, para_setor, quantidade, peso, data)
+                atualizados[(produto_id, para_setor)] = saldo
+
+        # 🔹 Um executemany no livro de movimentos
+        cursor.executemany("""
+            INSERT INTO movimentos (tipo, produto_id, de_setor, para_setor,
+                                    quantidade, peso, usuario_id, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(*movimento, usuario_id, data) for movimento in movimentos])
 
-    return jsonify({'quantidade': quantidade_disponivel})
+        db.commit()
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return jsonify({"erro": "Produto inexistente no lote"}), 400
+    except ValueError as e:
+        # Não deveria ocorrer após a simulação; os helpers são a palavra final
+        db.rollback()
+        return jsonify({"erro": str(e)}), 409
+    except Exception:
+        db.rollback()
+        raise
+
+    return jsonify({
+        "registrados": len(movimentos),
+        "saldos": [
+            {"produto_id": produto_id, "setor": setor, "quantidade": saldo["quantidade"], "peso": saldo["peso"]}
+            for (produto_id, setor), saldo in sorted(atualizados.items())
+        ]
+    })
+
+# ================= MÉTRICAS: /metrics =================
+def formatar_metricas():
+    """Renderiza os contadores no formato texto do Prometheus (0.0.4)."""
+    with _metricas_lock:
+        requisicoes = dict(_metricas["requisicoes"])
+        latencia = {k: list(v) for k, v in _metricas["latencia"].items()}
+        sql = {k: list(v) for k, v in _metricas["sql"].items()}
+        busy = dict(_metricas["busy"])
+
+    linhas = [
+        "# HELP almoxarifado_http_requests_total Requisições atendidas por endpoint, método e status.",
+        "# TYPE almoxarifado_http_requests_total counter",
+    ]
+    for (endpoint, metodo, status), total in sorted(requisicoes.items()):
+        linhas.append(
+            f'almoxarifado_http_requests_total{{endpoint="{endpoint}",metodo="{metodo}",status="{status}"}} {total}'
+        )
+
+    linhas += [
+        "# HELP almoxarifado_http_request_duration_seconds Latência das requisições por endpoint.",
+        "# TYPE almoxarifado_http_request_duration_seconds histogram",
+    ]
+    for endpoint, valores in sorted(latencia.items()):
+        for limite, contagem in zip(METRICAS_BUCKETS, valores):
+            linhas.append(
+                f'almoxarifado_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{limite}"}} {contagem}'
+            )
+        linhas.append(
+            f'almoxarifado_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {valores[-1]}'
+        )
+        linhas.append(f'almoxarifado_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {valores[-2]:.6f}')
+        linhas.append(f'almoxarifado_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {valores[-1]}')
+
+    for indice, nome, tipo, descricao in (
+        (0, "almoxarifado_sql_statements_total", "counter", "Comandos SQL executados por endpoint."),
+        (1, "almoxarifado_sql_duration_seconds_total", "counter", "Tempo gasto em SQL (execução + leitura) por endpoint."),
+        (2, "almoxarifado_sql_rows_fetched_total", "counter", "Linhas lidas do SQLite por endpoint."),
+    ):
+        linhas += [f"# HELP {nome} {descricao}", f"# TYPE {nome} {tipo}"]
+        for endpoint, valores in sorted(sql.items()):
+            valor = f"{valores[indice]:.6f}" if indice == 1 else valores[indice]
+            linhas.append(f'{nome}{{endpoint="{endpoint}"}} {valor}')
+
+    linhas += [
+        "# HELP almoxarifado_sqlite_busy_total Erros 'database is locked' (retentativa de BEGIN ou erro final).",
+        "# TYPE almoxarifado_sqlite_busy_total counter",
+    ]
+    for (endpoint, desfecho), total in sorted(busy.items()):
+        linhas.append(f'almoxarifado_sqlite_busy_total{{endpoint="{endpoint}",desfecho="{desfecho}"}} {total}')
+
+    return "\n".join(linhas) + "\n"
+
+
+@app.route('/metrics')
+def metrics():
+    # ADM logado ou scraper com ALMOXARIFADO_METRICS_TOKEN
+    autorizacao = request.headers.get('Authorization', '')
+    token_ok = bool(METRICAS_TOKEN) and hmac.compare_digest(autorizacao, f"Bearer {METRICAS_TOKEN}")
+
+    if not token_ok and session.get('perfil') != 'ADM':
+        return "Acesso negado\n", 403, {"Content-Type": "text/plain; charset=utf-8"}
+
+    return formatar_metricas(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# ================= ADMIN: CONSULTAS LENTAS =================
+@app.route('/admin/consultas_lentas', methods=['GET', 'POST'])
+@login_required
+@adm_required
+def consultas_lentas():
+    if request.method == 'POST':
+        with _consultas_lentas_lock:
+            _consultas_lentas.clear()
+        flash("Registro de consultas lentas limpo.", "success")
+        return redirect(url_for('consultas_lentas'))
+
+    with _consultas_lentas_lock:
+        consultas = sorted(
+            (dict(item) for item in _consultas_lentas.values()),
+            key=lambda item: item["max_ms"],
+            reverse=True
+        )
+
+    return render_template(
+        'consultas_lentas.html',
+        consultas=consultas,
+        limite_ms=CONSULTA_LENTA_MS,
+        top=CONSULTAS_LENTAS_TOP
+    )
+
+
+# ================= ARQUIVO MENSAL DE MOVIMENTOS =================
+# Meses fechados saem de movimentos para arquivo/AAAA-MM.db, sempre do mais
+# antigo para o mais novo: o banco principal só guarda datas mais recentes que
+# qualquer arquivo. Por isso as leituras percorrem as fontes em ordem
+# (principal, depois um arquivo por vez, do mais novo ao mais antigo) e anexam
+# apenas um arquivo de cada vez — bem abaixo do limite de ATTACH do SQLite.
+ARQUIVO_MESES_QUENTES = int(os.environ.get("ALMOXARIFADO_ARQUIVO_MESES_QUENTES", 3))
+
+ESQUEMA_ARQUIVO = """
+    CREATE TABLE IF NOT EXISTS movimentos (
+        id INTEGER PRIMARY KEY,
+        tipo TEXT NOT NULL,
+        produto_id INTEGER NOT NULL,
+        de_setor TEXT,
+        para_setor TEXT,
+        quantidade REAL DEFAULT 0,
+        peso REAL DEFAULT 0,
+        usuario_id INTEGER,
+        data TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_movimentos_tipo_data ON movimentos (tipo, data);
+    CREATE INDEX IF NOT EXISTS idx_movimentos_produto_data ON movimentos (produto_id, data);
+    CREATE INDEX IF NOT EXISTS idx_movimentos_produto_id ON movimentos (produto_id, id);
+"""
+
+
+def caminho_arquivo(nome):
+    return os.path.join(ARQUIVO_DIR, nome)
+
+
+def fontes_movimentos(conn, de=None, ate=None, apos=None, apos_id=None):
+    """
+    Fontes do livro na ordem de leitura: None (banco principal) e os meses
+    arquivados que cruzam [de, ate], do mais novo para o mais antigo.
+    Com o cursor `apos` ("data|id"), pula os meses inteiramente posteriores a ele;
+    com `apos_id`, os meses sem nenhum movimento de id maior.
+    """
+    fontes = [None]
+    for periodo in conn.execute("""
+        SELECT periodo, arquivo, ultimo_id FROM arquivo_periodos
+        WHERE estado = 'arquivado'
+        ORDER BY periodo DESC
+    """).fetchall():
+        if de and periodo["periodo"] < de[:7]:
+            continue
+        if ate and periodo["periodo"] > ate[:7]:
+            continue
+        if apos and periodo["periodo"] > apos[:7]:
+            continue
+        if apos_id is not None and periodo["ultimo_id"] is not None and periodo["ultimo_id"] <= apos_id:
+            continue
+        fontes.append(periodo)
+    return fontes
+
+
+@contextmanager
+def anexar_periodo(conn, periodo):
+    """
+    Anexa o arquivo do período como `arq` e devolve o esquema a consultar.
+    O ATTACH cria um banco vazio se o arquivo não existir, o que sumiria com o
+    mês das leituras sem aviso: arquivo ausente é erro.
+    """
+    if periodo is None:
+        yield "main"
+        return
+
+    caminho = caminho_arquivo(periodo["arquivo"])
+    if not os.path.isfile(caminho):
+        raise FileNotFoundError(f"Arquivo do período {periodo['periodo']} não encontrado: {caminho}")
+
+    conn.execute("ATTACH DATABASE ? AS arq", (caminho,))
+    try:
+        yield "arq"
+    finally:
+        conn.execute("DETACH DATABASE arq")
+
+
+def periodos_para_arquivar(conn, ate_periodo):
+    """Meses (AAAA-MM) com movimentos no banco principal até ate_periodo, em ordem."""
+    # MIN por tipo usa o índice (tipo, data)
+    inicio = conn.execute(f"""
+        SELECT MIN(primeira) FROM (
+            SELECT (SELECT MIN(data) FROM movimentos WHERE tipo = t.tipo) AS primeira
+            FROM (SELECT value AS tipo FROM json_each(?)) AS t
+        )
+    """, (json.dumps(TIPOS_MOVIMENTO),)).fetchone()[0]
+
+    if not inicio or inicio[:7] > ate_periodo:
+        return []
+
+    periodos = []
+    ano, mes = int(inicio[:4]), int(inicio[5:7])
+    while f"{ano:04d}-{mes:02d}" <= ate_periodo:
+        periodos.append(f"{ano:04d}-{mes:02d}")
+        ano, mes = (ano + 1, 1) if mes == 12 else (ano, mes + 1)
+    return periodos
+
+
+def arquivar_periodo(conn, periodo):
+    """
+    Move os movimentos de um mês para arquivo/AAAA-MM.db. Retomável: se cair no
+    meio, rodar de novo completa o serviço sem duplicar nada.
+    1. copia para o arquivo (INSERT OR IGNORE pelo id) e faz commit;
+    2. numa transação só do banco principal, soma o efeito das linhas copiadas
+       em saldos_arquivados, atualiza o controle e apaga as linhas — só as que
+       já estão no arquivo. O principal nunca perde linha que o arquivo não tenha.
+    Retorna quantos movimentos saíram do banco principal.
+    """
+    ano, mes = int(periodo[:4]), int(periodo[5:7])
+    inicio = f"{periodo}-01"
+    fim = f"{ano + 1:04d}-01-01" if mes == 12 else f"{ano:04d}-{mes + 1:02d}-01"
+    nome = f"{periodo}.db"
+    agora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    marcadores = ", ".join("?" * len(TIPOS_MOVIMENTO))
+    faixa = f"tipo IN ({marcadores}) AND data >= ? AND data < ?"
+    params_faixa = [*TIPOS_MOVIMENTO, inicio, fim]
+
+    os.makedirs(ARQUIVO_DIR, exist_ok=True)
+    arquivo = sqlite3.connect(caminho_arquivo(nome))
+    arquivo.execute("PRAGMA journal_mode = DELETE")
+    arquivo.executescript(ESQUEMA_ARQUIVO)
+    arquivo.close()
+
+    conn.execute("""
+        INSERT INTO arquivo_periodos (periodo, arquivo, estado, atualizado_em)
+        VALUES (?, ?, 'copiando', ?)
+        ON CONFLICT (periodo) DO NOTHING
+    """, (periodo, nome, agora))
+    conn.commit()
+
+    conn.execute("ATTACH DATABASE ? AS arq", (caminho_arquivo(nome),))
+    try:
+        # 1. cópia (commit grava só o arquivo)
+        conn.execute("PRAGMA arq.synchronous = FULL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"""
+                INSERT OR IGNORE INTO arq.movimentos
+                    (id, tipo, produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data)
+                SELECT id, tipo, produto_id, de_setor, para_setor, quantidade, peso, usuario_id, data
+                FROM main.movimentos
+                WHERE {faixa}
+            """, params_faixa)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        # 2. saldo acumulado + remoção (commit grava só o principal)
+        copiadas = "main.movimentos.id IN (SELECT id FROM arq.movimentos)"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"""
+                INSERT INTO main.saldos_arquivados (produto_id, setor, quantidade, peso)
+                SELECT produto_id, setor, SUM(quantidade), SUM(peso)
+                FROM (
+                    SELECT produto_id, para_setor AS setor, quantidade, peso
+                    FROM main.movimentos
+                    WHERE {copiadas} AND para_setor IS NOT NULL
+                    UNION ALL
+                    SELECT produto_id, de_setor, -quantidade, -peso
+                    FROM main.movimentos
+                    WHERE {copiadas} AND de_setor IS NOT NULL
+                )
+                WHERE true
+                GROUP BY produto_id, setor
+                ON CONFLICT (produto_id, setor) DO UPDATE SET
+                    quantidade = quantidade + excluded.quantidade,
+                    peso = peso + excluded.peso
+            """)
+
+            contagem = dict(conn.execute(
+                f"SELECT tipo, COUNT(*) FROM main.movimentos WHERE {copiadas} GROUP BY tipo"
+            ).fetchall())
+            controle = conn.execute(
+                "SELECT movimentos, contagem FROM main.arquivo_periodos WHERE periodo = ?", (periodo,)
+            ).fetchone()
+            acumulado = json.loads(controle["contagem"])
+            for tipo, total in contagem.items():
+                acumulado[tipo] = acumulado.get(tipo, 0) + total
+
+            removidos = conn.execute(f"DELETE FROM main.movimentos WHERE {copiadas}").rowcount
+            conn.execute("""
+                UPDATE main.arquivo_periodos
+                SET estado = 'arquivado', movimentos = ?, contagem = ?, atualizado_em = ?,
+                    ultimo_id = (SELECT MAX(id) FROM arq.movimentos)
+                WHERE periodo = ?
+            """, (controle["movimentos"] + removidos, json.dumps(acumulado), agora, periodo))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute("DETACH DATABASE arq")
+
+    return removidos
+
+
+# ================= RECONCILIAÇÃO: LIVRO x ESTOQUE =================
+# estoque é um cache do livro de movimentos. A reconciliação recalcula o saldo
+# esperado de cada (produto, setor) a partir de movimentos, em blocos de
+# produtos processados em paralelo (um processo e uma conexão somente leitura
+# por bloco), e compara com o estoque gravado.
+RECONCILIACAO_TAMANHO_BLOCO = 2000
+
+
+def blocos_de_produtos(conn, tamanho_bloco):
+    """Faixas (primeiro_id, ultimo_id) com até tamanho_bloco produtos cada."""
+    ids = [row[0] for row in conn.execute("SELECT id FROM produtos ORDER BY id")]
+    return [(ids[i], ids[min(i + tamanho_bloco, len(ids)) - 1]) for i in range(0, len(ids), tamanho_bloco)]
+
+
+def reconciliar_bloco(caminho_db, primeiro_id, ultimo_id, tolerancia=1e-6):
+    """
+    Roda num processo do pool. Compara estoque e livro para os produtos do bloco
+    numa única transação de leitura (mesmo instante para os dois lados).
+    Retorna (pares verificados, lançamentos lidos, divergências) — transferência
+    conta como dois lançamentos (origem e destino) — e cada divergência
+    como (produto_id, setor, quantidade gravada, esperada, peso gravado, esperado).
+    """
+    conn = sqlite3.connect(f"file:{caminho_db}?mode=ro", uri=True)
+    try:
+        conn.execute("BEGIN")
+        esperado = {}
+        lancamentos = 0
+        for produto_id, setor, quantidade, peso, linhas in conn.execute("""
+            SELECT produto_id, setor, SUM(quantidade), SUM(peso), COUNT(*)
+            FROM (
+                SELECT produto_id, para_setor AS setor, quantidade, peso
+                FROM movimentos
+                WHERE produto_id BETWEEN ? AND ? AND para_setor IS NOT NULL
+                UNION ALL
+                SELECT produto_id, de_setor, -quantidade, -peso
+                FROM movimentos
+                WHERE produto_id BETWEEN ? AND ? AND de_setor IS NOT NULL
+            )
+            GROUP BY produto_id, setor
+        """, (primeiro_id, ultimo_id, primeiro_id, ultimo_id)):
+            esperado[(produto_id, setor)] = (quantidade or 0, peso or 0)
+            lancamentos += linhas
+
+        # Meses arquivados entram pelo saldo acumulado (mesma transação de leitura)
+        for produto_id, setor, quantidade, peso in conn.execute("""
+            SELECT produto_id, setor, quantidade, peso
+            FROM saldos_arquivados
+            WHERE produto_id BETWEEN ? AND ?
+        """, (primeiro_id, ultimo_id)):
+            anterior = esperado.get((produto_id, setor), (0, 0))
+            esperado[(produto_id, setor)] = (anterior[0] + quantidade, anterior[1] + peso)
+
+        gravado = {
+            (produto_id, setor): (quantidade, peso)
+            for produto_id, setor, quantidade, peso in conn.execute("""
+                SELECT produto_id, setor, quantidade, peso
+                FROM estoque
+                WHERE produto_id BETWEEN ? AND ?
+            """, (primeiro_id, ultimo_id))
+        }
+        conn.rollback()
+    finally:
+        conn.close()
+
+    divergencias = []
+    for par in esperado.keys() | gravado.keys():
+        quantidade, peso = gravado.get(par, (0, 0))
+        quantidade_esperada, peso_esperado = esperado.get(par, (0, 0))
+        if abs(quantidade - quantidade_esperada) > tolerancia or abs(peso - peso_esperado) > tolerancia:
+            divergencias.append((*par, quantidade, quantidade_esperada, peso, peso_esperado))
+
+    return len(esperado.keys() | gravado.keys()), lancamentos, divergencias
+
+
+def reconciliar_estoque(caminho_db, processos=None, tamanho_bloco=RECONCILIACAO_TAMANHO_BLOCO, tolerancia=1e-6):
+    """Distribui os blocos num ProcessPoolExecutor e junta os resultados."""
+    conn = conectar()
+    blocos = blocos_de_produtos(conn, tamanho_bloco)
+    conn.close()
+
+    resumo = {"blocos": len(blocos), "pares": 0, "lancamentos": 0}
+    divergencias = []
+    with ProcessPoolExecutor(max_workers=processos) as executor:
+        futuros = [
+            executor.submit(reconciliar_bloco, caminho_db, primeiro, ultimo, tolerancia)
+            for primeiro, ultimo in blocos
+        ]
+        for futuro in futuros:
+            pares, lancamentos, encontradas = futuro.result()
+            resumo["pares"] += pares
+            resumo["lancamentos"] += lancamentos
+            divergencias.extend(encontradas)
+
+    divergencias.sort()
+    return resumo, divergencias
+
+
+def corrigir_divergencias(conn, divergencias):
+    """
+    Aplica a diferença (esperado - gravado) de cada par. Somar a diferença, em
+    vez de sobrescrever, preserva movimentos gravados depois da leitura.
+    """
+    data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("""
+            INSERT INTO estoque (produto_id, setor, quantidade, peso, atualizado_em)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (produto_id, setor) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso,
+                atualizado_em = excluded.atualizado_em
+        """, [
+            (produto_id, setor, esperada - quantidade, peso_esperado - peso, data)
+            for produto_id, setor, quantidade, esperada, peso, peso_esperado in divergencias
+        ])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# ================= COMANDOS (flask --app app <comando>) =================
+@app.cli.command("checkpoint")
+def comando_checkpoint():
+    """Checkpoint TRUNCATE do WAL (ex.: agendado fora do horário de pico)."""
+    ocupado, paginas_wal, paginas_copiadas = checkpoint_wal("TRUNCATE")
+    print(f"checkpoint: ocupado={ocupado} wal={paginas_wal} copiadas={paginas_copiadas}")
+
+@app.cli.command("verificar-agregados")
+@click.option("--corrigir", is_flag=True, help="Reescreve os agregados a partir do estoque.")
+def comando_verificar_agregados(corrigir):
+    """Recalcula os agregados de estoque do zero e informa divergências."""
+    conn = conectar()
+    cursor = conn.cursor()
+
+    # Uma transação só: todas as leituras enxergam o mesmo instante do banco
+    cursor.execute("BEGIN IMMEDIATE" if corrigir else "BEGIN")
+    divergencias = verificar_agregados(cursor)
+    for tabela, chave, gravado, esperado in divergencias:
+        print(f"⚠️  {tabela}[{chave}]: gravado={gravado} esperado={esperado}")
+
+    if not divergencias:
+        print("✅ Agregados consistentes")
+    elif corrigir:
+        recalcular_agregados(cursor)
+        print(f"🔧 {len(divergencias)} divergência(s) corrigida(s)")
+
+    conn.commit()
+    conn.close()
+
+@app.cli.command("importar-produtos")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--erros", "arquivo_erros", type=click.Path(dir_okay=False),
+              help="Grava as linhas com erro neste CSV.")
+def comando_importar_produtos(arquivo, arquivo_erros):
+    """Importa produtos e saldos iniciais de um CSV ou XLSX."""
+    conn = conectar()
+    inicio = time.monotonic()
+
+    with open(arquivo, 'rb') as f:
+        resumo, erros = importar_produtos(conn, ler_linhas_importacao(f, arquivo))
+    conn.close()
+
+    if resumo["interrompido"]:
+        print(f"❌ Arquivo ilegível: {resumo['interrompido']}")
+
+    print(
+        f"✅ {resumo['linhas']} linha(s) em {time.monotonic() - inicio:.1f}s: "
+        f"{resumo['novos']} novo(s), {resumo['atualizados']} atualizado(s), "
+        f"{resumo['saldos']} saldo(s) inicial(is), {len(erros)} erro(s)"
+    )
+
+    if erros and arquivo_erros:
+        with open(arquivo_erros, 'w', newline='', encoding='utf-8') as f:
+            escritor = csv.writer(f)
+            escritor.writerow(['linha', 'erro'])
+            escritor.writerows(erros)
+    else:
+        for numero, mensagem in erros[:50]:
+            print(f"⚠️  linha {numero}: {mensagem}")
+
+@app.cli.command("reconciliar")
+@click.option("--processos", type=int, help="Processos no pool (padrão: núcleos da máquina).")
+@click.option("--tamanho-bloco", default=RECONCILIACAO_TAMANHO_BLOCO, show_default=True,
+              help="Produtos por bloco.")
+@click.option("--tolerancia", default=1e-6, show_default=True)
+@click.option("--corrigir", is_flag=True, help="Ajusta o estoque ao saldo do livro de movimentos.")
+def comando_reconciliar(processos, tamanho_bloco, tolerancia, corrigir):
+    """Confere o estoque contra o livro de movimentos, em paralelo."""
+    inicio = time.monotonic()
+    resumo, divergencias = reconciliar_estoque(DATABASE, processos, tamanho_bloco, tolerancia)
+
+    for produto_id, setor, quantidade, esperada, peso, peso_esperado in divergencias[:50]:
+        print(
+            f"⚠️  produto {produto_id} / {setor}: quantidade {quantidade} (esperado {esperada}), "
+            f"peso {peso} (esperado {peso_esperado})"
+        )
+    if len(divergencias) > 50:
+        print(f"... e mais {len(divergencias) - 50}")
+
+    print(
+        f"{'✅' if not divergencias else '⚠️ '} {resumo['pares']} par(es) em {resumo['blocos']} bloco(s), "
+        f"{resumo['lancamentos']} lançamento(s) lidos em {time.monotonic() - inicio:.1f}s: "
+        f"{len(divergencias)} divergência(s)"
+    )
+
+    if divergencias and corrigir:
+        conn = conectar()
+        corrigir_divergencias(conn, divergencias)
+        conn.close()
+        print(f"🔧 {len(divergencias)} par(es) ajustado(s) ao livro de movimentos")
+
+@app.cli.command("arquivar")
+@click.option("--meses-quentes", default=ARQUIVO_MESES_QUENTES, show_default=True,
+              help="Meses recentes (além do atual) que ficam no banco principal.")
+@click.option("--ate", "ate_periodo", help="Arquiva até este mês (AAAA-MM) em vez de usar --meses-quentes.")
+def comando_arquivar(meses_quentes, ate_periodo):
+    """Move meses fechados de movimentos para arquivo/AAAA-MM.db."""
+    hoje = datetime.now()
+    atual = hoje.year * 12 + hoje.month - 1
+    limite = atual - meses_quentes - 1
+    ultimo_permitido = f"{limite // 12:04d}-{limite % 12 + 1:02d}"
+
+    if ate_periodo:
+        try:
+            datetime.strptime(ate_periodo, "%Y-%m")
+        except ValueError:
+            raise click.BadParameter("use AAAA-MM", param_hint="--ate")
+        mes_atual = f"{hoje.year:04d}-{hoje.month:02d}"
+        if ate_periodo >= mes_atual:
+            raise click.BadParameter("só meses fechados podem ser arquivados", param_hint="--ate")
+        ultimo_permitido = ate_periodo
+
+    conn = conectar()
+    periodos = periodos_para_arquivar(conn, ultimo_permitido)
+    if not periodos:
+        print(f"✅ Nada a arquivar até {ultimo_permitido}")
+
+    for periodo in periodos:
+        inicio = time.monotonic()
+        removidos = arquivar_periodo(conn, periodo)
+        print(f"📦 {periodo}: {removidos} movimento(s) arquivado(s) em {time.monotonic() - inicio:.1f}s")
+
+    conn.close()
+
+@app.cli.command("snapshot-estoque")
+@click.option("--manter-dias", type=int, help="Apaga snapshots mais antigos que N dias.")
+def comando_snapshot_estoque(manter_dias):
+    """Grava um snapshot do estoque (base do saldo em data)."""
+    conn = conectar()
+    snapshot = tirar_snapshot(conn)
+    print(
+        f"✅ Snapshot {snapshot['id']} em {snapshot['data']}: {snapshot['itens']} par(es), "
+        f"até o movimento {snapshot['ultimo_movimento_id']}"
+    )
+
+    if manter_dias:
+        corte = (datetime.now() - timedelta(days=manter_dias)).strftime('%Y-%m-%d %H:%M:%S')
+        # O mais recente fica sempre, mesmo que seja antigo
+        apagados = conn.execute("""
+            DELETE FROM estoque_snapshots
+            WHERE data < ? AND id != (SELECT MAX(id) FROM estoque_snapshots)
+        """, (corte,)).rowcount
+        conn.commit()
+        print(f"🧹 {apagados} snapshot(s) anterior(es) a {corte} removido(s)")
+
+    conn.close()
 
 # ================= INICIALIZAÇÃO =================
-if __name__ == '__main__':
-    criar_banco()
-    # app.run(debug=True)  # REMOVIDO para produção no Railway
+# Sob gunicorn o bloco __main__ não roda: tabelas e migrações pendentes são
+# garantidas na importação (idempotente; só lê user_version quando já aplicadas)
+criar_banco()
+
+# app.run(debug=True)  # REMOVIDO para produção no Railway
 
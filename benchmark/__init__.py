@@ -0,0 +1,30 @@
+"""
+Benchmark do almoxarifado.
+
+    python -m benchmark gerar --db bench.db --produtos 2000 --movimentos 200000
+    python -m benchmark executar --db bench.db --threads 1,4,8 --saida resultado.json
+
+O gerador cria o banco pelo schema real (criar_banco + migrações) e o executor
+mede registrar_movimento e as rotas principais pelo test client do Flask.
+"""
+import contextlib
+import importlib
+import os
+import sys
+
+
+def carregar_app(caminho_db):
+    """
+    Importa o módulo app apontando para caminho_db. O app cria/migra o banco
+    na importação, então ALMOXARIFADO_DB precisa estar definido antes.
+    As mensagens da criação do banco vão para stderr, deixando stdout só com o JSON.
+    """
+    if "app" in sys.modules:
+        modulo = sys.modules["app"]
+        if os.path.abspath(modulo.DATABASE) != os.path.abspath(caminho_db):
+            raise RuntimeError(f"app já importado com outro banco: {modulo.DATABASE}")
+        return modulo
+
+    os.environ["ALMOXARIFADO_DB"] = caminho_db
+    with contextlib.redirect_stdout(sys.stderr):
+        return importlib.import_module("app")
@@ -0,0 +1,60 @@
+"""python -m benchmark <gerar|executar> — ver benchmark/__init__.py."""
+import json
+import os
+
+import click
+
+
+@click.group()
+def cli():
+    """Gerador de dados sintéticos e benchmark do almoxarifado."""
+
+
+@cli.command("gerar")
+@click.option("--db", "caminho_db", default="benchmark.db", show_default=True, help="Banco a popular.")
+@click.option("--produtos", default=1000, show_default=True)
+@click.option("--setores", default=3, show_default=True)
+@click.option("--movimentos", default=100000, show_default=True)
+@click.option("--dias", default=365, show_default=True, help="Período coberto pelos movimentos.")
+@click.option("--semente", default=42, show_default=True)
+@click.option("--substituir", is_flag=True, help="Apaga o banco se ele já existir.")
+def comando_gerar(caminho_db, produtos, setores, movimentos, dias, semente, substituir):
+    """Cria um banco com N produtos, M setores e K movimentos."""
+    if os.path.exists(caminho_db):
+        if not substituir:
+            raise click.UsageError(f"{caminho_db} já existe (use --substituir)")
+        for sufixo in ("", "-wal", "-shm"):
+            if os.path.exists(caminho_db + sufixo):
+                os.remove(caminho_db + sufixo)
+
+    from benchmark.gerador import gerar
+    resumo = gerar(caminho_db, produtos, setores, movimentos, dias, semente)
+    click.echo(json.dumps(resumo, ensure_ascii=False, indent=2))
+
+
+@cli.command("executar")
+@click.option("--db", "caminho_db", default="benchmark.db", show_default=True)
+@click.option("--iteracoes", default=200, show_default=True, help="Chamadas por cenário e nível de threads.")
+@click.option("--threads", default="1,4,8", show_default=True, help="Níveis de concorrência.")
+@click.option("--cenario", "somente", multiple=True, help="Roda só cenários cujo nome contém o texto.")
+@click.option("--semente", default=42, show_default=True)
+@click.option("--saida", type=click.Path(dir_okay=False), help="Grava o JSON também neste arquivo.")
+def comando_executar(caminho_db, iteracoes, threads, somente, semente, saida):
+    """Mede vazão e latência (p50/p95/p99) e imprime o resultado em JSON."""
+    if not os.path.exists(caminho_db):
+        raise click.UsageError(f"{caminho_db} não existe (rode 'gerar' antes)")
+
+    niveis = [int(n) for n in threads.split(",") if n.strip()]
+
+    from benchmark.executor import executar
+    relatorio = executar(caminho_db, iteracoes, niveis, somente, semente)
+
+    texto = json.dumps(relatorio, ensure_ascii=False, indent=2)
+    if saida:
+        with open(saida, "w", encoding="utf-8") as arquivo:
+            arquivo.write(texto)
+    click.echo(texto)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,177 @@
+"""
+Executor do benchmark: mede registrar_movimento e as rotas principais,
+com 1..N threads concorrentes, e devolve vazão e latências (p50/p95/p99).
+"""
+import platform
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import carregar_app
+
+
+def percentil(valores_ordenados, p):
+    """Percentil pelo método nearest-rank (valores já ordenados)."""
+    if not valores_ordenados:
+        return 0.0
+    indice = max(int(round(p / 100 * len(valores_ordenados) + 0.5)) - 1, 0)
+    return valores_ordenados[min(indice, len(valores_ordenados) - 1)]
+
+
+def medir(nome, preparar, operacao, iteracoes, threads):
+    """
+    Roda `iteracoes` chamadas de operacao(contexto, i) divididas entre `threads`.
+    preparar() é chamado uma vez por thread e devolve o contexto dela
+    (conexão, test client...), fora da medição.
+    """
+    latencias = []
+    erros = []
+    recusas = 0
+    trava = threading.Lock()
+    barreira = threading.Barrier(threads)
+
+    def trabalhador(indice_thread):
+        nonlocal recusas
+        contexto = preparar()
+        locais, recusas_locais, erros_locais = [], 0, []
+        barreira.wait()
+
+        for i in range(indice_thread, iteracoes, threads):
+            inicio = time.perf_counter()
+            try:
+                if operacao(contexto, i) is False:
+                    recusas_locais += 1
+            except Exception as e:
+                erros_locais.append(f"{type(e).__name__}: {e}")
+            locais.append(time.perf_counter() - inicio)
+
+        with trava:
+            latencias.extend(locais)
+            erros.extend(erros_locais)
+            recusas += recusas_locais
+
+        fechar = getattr(contexto, "close", None)
+        if fechar:
+            fechar()
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(trabalhador, range(threads)))
+    duracao = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        "cenario": nome,
+        "threads": threads,
+        "iteracoes": len(latencias),
+        "erros": len(erros),
+        "exemplos_erros": sorted(set(erros))[:3],
+        "recusas": recusas,
+        "duracao_s": round(duracao, 4),
+        "vazao_por_s": round(len(latencias) / duracao, 2) if duracao else 0.0,
+        "p50_ms": round(percentil(latencias, 50) * 1000, 3),
+        "p95_ms": round(percentil(latencias, 95) * 1000, 3),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 3),
+        "max_ms": round(latencias[-1] * 1000, 3) if latencias else 0.0,
+    }
+
+
+def cenarios(app, amostra, usuario_id, semente):
+    """Monta os cenários (nome, preparar, operacao) sobre a amostra de pares (produto, setor)."""
+    flask_app = app.app
+
+    def cliente():
+        c = flask_app.test_client()
+        with c.session_transaction() as s:
+            s["user_id"] = usuario_id
+            s["user_nome"] = "benchmark"
+            s["perfil"] = "ADM"
+        return c
+
+    setores = sorted({setor for _, setor in amostra})
+
+    def par(i):
+        return amostra[(i * 7919 + semente) % len(amostra)]
+
+    def rota(caminho):
+        def operacao(c, i):
+            resposta = c.get(caminho(i) if callable(caminho) else caminho)
+            if resposta.status_code != 200:
+                raise RuntimeError(f"HTTP {resposta.status_code}")
+        return operacao
+
+    def movimento(conn, i):
+        produto_id, setor = par(i)
+        try:
+            if i % 2:
+                app.registrar_movimento(conn, "saida", produto_id, setor_origem=setor,
+                                        quantidade=1, peso=0, usuario_id=usuario_id)
+            else:
+                app.registrar_movimento(conn, "entrada", produto_id, setor_destino=setor,
+                                        quantidade=1, peso=0, usuario_id=usuario_id)
+        except ValueError:
+            return False  # saldo insuficiente: regra de negócio, não erro
+
+    def transferencia(c, i):
+        produto_id, setor = par(i)
+        destino = setores[(setores.index(setor) + 1) % len(setores)]
+        resposta = c.post("/transferir", data={
+            "produto_id": produto_id, "de_setor": setor, "para_setor": destino,
+            "quantidade": 1, "peso": 0,
+        })
+        if resposta.status_code != 302:
+            raise RuntimeError(f"HTTP {resposta.status_code}")
+
+    return [
+        ("registrar_movimento", app.conectar, movimento),
+        ("GET /dashboard", cliente, rota("/dashboard")),
+        ("GET /dashboard/dados", cliente, rota("/dashboard/dados")),
+        ("GET /relatorios", cliente, rota("/relatorios")),
+        ("GET /transferir", cliente, rota("/transferir")),
+        ("POST /transferir", cliente, transferencia),
+        ("GET /estoque/saldo", cliente, rota(
+            lambda i: "/estoque/saldo?produto_id={}&setor={}".format(*par(i))
+        )),
+    ]
+
+
+def executar(caminho_db, iteracoes=200, threads=(1, 4, 8), somente=None, semente=42):
+    """Roda todos os cenários para cada nível de concorrência e devolve o relatório."""
+    app = carregar_app(caminho_db)
+    rnd = random.Random(semente)
+
+    conn = app.conectar()
+    usuario_id = conn.execute("SELECT MIN(id) FROM usuarios WHERE perfil = 'ADM'").fetchone()[0]
+    pares = [tuple(row) for row in conn.execute(
+        "SELECT produto_id, setor FROM estoque ORDER BY produto_id, setor"
+    )]
+    totais = {
+        "produtos": conn.execute("SELECT COUNT(*) FROM produtos").fetchone()[0],
+        "movimentos": conn.execute("SELECT COUNT(*) FROM movimentos").fetchone()[0],
+    }
+    conn.close()
+
+    if not pares:
+        raise RuntimeError("Banco sem estoque: rode 'python -m benchmark gerar' antes")
+
+    amostra = rnd.sample(pares, min(len(pares), 1000))
+
+    resultados = []
+    for nome, preparar, operacao in cenarios(app, amostra, usuario_id, semente):
+        if somente and not any(filtro in nome for filtro in somente):
+            continue
+        for n in threads:
+            resultados.append(medir(nome, preparar, operacao, iteracoes, n))
+
+    return {
+        "banco": caminho_db,
+        "quando": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "semente": semente,
+        "iteracoes": iteracoes,
+        **totais,
+        "resultados": resultados,
+    }
@@ -0,0 +1,170 @@
+"""
+Gerador de dados sintéticos: N produtos, M setores e K movimentos com semente fixa.
+
+Os movimentos são simulados em memória (saída e transferência só com saldo),
+gravados em lote no livro de movimentos, como registrar_movimento faz, e o estoque
+final é gravado uma vez — os triggers mantêm os agregados.
+"""
+import random
+import time
+from datetime import datetime, timedelta
+
+from benchmark import carregar_app
+
+# Os três primeiros são os setores usados pelas telas
+SETORES_PADRAO = ["Almoxarifado", "Produção", "Expedição"]
+
+NOMES = ["Parafuso", "Porca", "Arruela", "Rebite", "Chapa", "Tubo", "Perfil",
+         "Cabo", "Conector", "Luva", "Bucha", "Mola", "Eixo", "Rolamento", "Correia"]
+ACABAMENTOS = ["Zincado", "Inox", "Galvanizado", "Bruto", "Pintado", "Cromado"]
+TAMANHOS = ["M4", "M6", "M8", "M10", "M12", "1/4\"", "3/8\"", "1/2\""]
+
+# Peso relativo de cada tipo de movimento
+PESOS_TIPOS = {"entrada": 45, "saida": 30, "transferencia": 20, "ajuste": 5}
+
+TAMANHO_LOTE = 10000
+
+
+def nomes_setores(quantidade):
+    setores = SETORES_PADRAO[:quantidade]
+    setores += [f"Setor {i}" for i in range(len(setores) + 1, quantidade + 1)]
+    return setores
+
+
+def gerar_produtos(rnd, quantidade):
+    produtos = []
+    for i in range(1, quantidade + 1):
+        nome = f"{rnd.choice(NOMES)} {rnd.choice(ACABAMENTOS)} {rnd.choice(TAMANHOS)}"
+        produtos.append((
+            f"BENCH-{i:06d}",
+            nome,
+            f"{nome} (lote sintético {i})",
+            rnd.choice(TAMANHOS),
+            round(rnd.uniform(0.01, 5.0), 3),
+        ))
+    return produtos
+
+
+def gerar_movimentos(rnd, produtos, setores, quantidade, dias, usuario_id):
+    """
+    Gera (tipo, produto_id, de_setor, para_setor, quantidade, peso, data) em ordem
+    de data e devolve também o saldo final por (produto_id, setor).
+    """
+    saldos = {}
+    tipos = list(PESOS_TIPOS)
+    pesos = list(PESOS_TIPOS.values())
+
+    fim = datetime.now().replace(microsecond=0)
+    inicio = fim - timedelta(days=dias)
+    passo = (fim - inicio) / max(quantidade + len(produtos), 1)
+    instante = inicio
+
+    movimentos = []
+
+    # Cadastro inicial de cada produto ('novo'), como faz a tela de novo produto
+    for produto_id, peso_unitario in produtos:
+        setor = rnd.choice(setores)
+        qtd = float(rnd.randint(0, 50))
+        saldos[(produto_id, setor)] = [qtd, qtd * peso_unitario]
+        movimentos.append(("novo", produto_id, None, setor, qtd, qtd * peso_unitario,
+                           usuario_id, instante.strftime('%Y-%m-%d %H:%M:%S')))
+        instante += passo
+
+    for _ in range(quantidade):
+        produto_id, peso_unitario = rnd.choice(produtos)
+        tipo = rnd.choices(tipos, pesos)[0]
+        qtd = float(rnd.randint(1, 20))
+        origem = destino = None
+
+        if tipo in ("saida", "transferencia"):
+            origem = rnd.choice(setores)
+            disponivel = saldos.get((produto_id, origem), [0, 0])[0]
+            if disponivel < qtd:
+                tipo, origem = "entrada", None
+
+        if tipo == "transferencia":
+            destino = rnd.choice([s for s in setores if s != origem] or setores)
+        elif tipo != "saida":
+            destino = rnd.choice(setores)
+
+        peso = qtd * peso_unitario
+        if origem:
+            saldo = saldos[(produto_id, origem)]
+            saldo[0] -= qtd
+            saldo[1] = max(saldo[1] - peso, 0)
+        if destino:
+            saldo = saldos.setdefault((produto_id, destino), [0, 0])
+            saldo[0] += qtd
+            saldo[1] += peso
+
+        movimentos.append((tipo, produto_id, origem, destino, qtd, peso,
+                           usuario_id, instante.strftime('%Y-%m-%d %H:%M:%S')))
+        instante += passo
+
+    return movimentos, saldos
+
+
+def gravar_movimentos(cursor, movimentos):
+    """Grava no livro de movimentos, como registrar_movimento."""
+    cursor.executemany("""
+        INSERT INTO movimentos (tipo, produto_id, de_setor, para_setor,
+                                quantidade, peso, usuario_id, data)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, movimentos)
+
+
+def gerar(caminho_db, produtos=1000, setores=3, movimentos=100000, dias=365, semente=42):
+    """Popula caminho_db e devolve um resumo do que foi gerado."""
+    app = carregar_app(caminho_db)
+    rnd = random.Random(semente)
+    inicio = time.perf_counter()
+
+    conn = app.conectar()
+    cursor = conn.cursor()
+    usuario_id = cursor.execute("SELECT MIN(id) FROM usuarios WHERE perfil = 'ADM'").fetchone()[0]
+    lista_setores = nomes_setores(setores)
+
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        linhas = gerar_produtos(rnd, produtos)
+        cursor.executemany("""
+            INSERT INTO produtos (codigo, nome, descricao, tamanho, peso_unitario)
+            VALUES (?, ?, ?, ?, ?)
+        """, linhas)
+        catalogo = cursor.execute(
+            "SELECT id, peso_unitario FROM produtos WHERE codigo LIKE 'BENCH-%' ORDER BY id"
+        ).fetchall()
+        catalogo = [(row[0], row[1]) for row in catalogo]
+
+        lista, saldos = gerar_movimentos(rnd, catalogo, lista_setores, movimentos, dias, usuario_id)
+        for i in range(0, len(lista), TAMANHO_LOTE):
+            gravar_movimentos(cursor, lista[i:i + TAMANHO_LOTE])
+
+        data = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor.executemany("""
+            INSERT INTO estoque (produto_id, setor, quantidade, peso, atualizado_em)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (produto_id, setor) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                peso = peso + excluded.peso,
+                atualizado_em = excluded.atualizado_em
+        """, [(pid, setor, qtd, peso, data) for (pid, setor), (qtd, peso) in saldos.items()])
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    cursor.execute("ANALYZE")
+    conn.close()
+    app.checkpoint_wal("TRUNCATE")
+
+    return {
+        "banco": caminho_db,
+        "semente": semente,
+        "produtos": produtos,
+        "setores": lista_setores,
+        "movimentos": len(lista),
+        "pares_estoque": len(saldos),
+        "duracao_s": round(time.perf_counter() - inicio, 3),
+    }
@@ -0,0 +1,66 @@
+// ================= Busca de produtos (autocomplete) =================
+// Preenche o <select> de produto com o resultado de /api/produtos/busca,
+// mantendo os atributos data-* que as telas já usam (peso, estoque, código).
+// incluirInativos: filtros de relatório, que também consultam produtos inativos.
+function ativarBuscaProduto(campo, select, limite = 15, incluirInativos = false) {
+    let temporizador = null;
+    let controle = null;
+
+    function preencher(produtos, mensagem) {
+        select.innerHTML = '';
+
+        const vazio = document.createElement('option');
+        vazio.value = '';
+        vazio.disabled = true;
+        vazio.selected = true;
+        vazio.textContent = mensagem || (produtos.length
+            ? `${produtos.length} produto(s) encontrado(s)`
+            : 'Nenhum produto encontrado');
+        select.appendChild(vazio);
+
+        produtos.forEach(p => {
+            const opt = document.createElement('option');
+            opt.value = p.id;
+            opt.dataset.peso = p.peso_unitario;
+            opt.dataset.estoque = p.quantidade_estoque;
+            opt.dataset.codigo = p.codigo;
+            opt.textContent = p.nome;
+            select.appendChild(opt);
+        });
+
+        // Um único resultado já fica selecionado
+        if (produtos.length === 1) {
+            select.value = produtos[0].id;
+            select.dispatchEvent(new Event('change'));
+        }
+    }
+
+    async function buscar() {
+        const termo = campo.value.trim();
+        if (!termo) {
+            preencher([], 'Digite para buscar');
+            return;
+        }
+
+        // Cancela a busca anterior ainda em andamento
+        if (controle) controle.abort();
+        controle = new AbortController();
+
+        try {
+            const resp = await fetch(
+                `/api/produtos/busca?q=${encodeURIComponent(termo)}&limite=${limite}`
+                    + (incluirInativos ? '&inativos=1' : ''),
+                { signal: controle.signal }
+            );
+            const dados = await resp.json();
+            preencher(dados.produtos);
+        } catch (e) {
+            if (e.name !== 'AbortError') console.error(e);
+        }
+    }
+
+    campo.addEventListener('input', () => {
+        clearTimeout(temporizador);
+        temporizador = setTimeout(buscar, 200);
+    });
+}